@@ -0,0 +1,693 @@
+import argparse
+import copy
+import os
+import time
+from collections import defaultdict
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from env import KickerEnv
+from rewards import RewardEngine, synchronize
+from train import get_cfgs, get_train_cfg
+from curriculum import get_reward_scales
+from rsl_rl.algorithms import PPO
+from rsl_rl.modules import ActorCritic, ActorCriticRecurrent
+from rsl_rl.runners import OnPolicyRunner
+from rsl_rl.storage import RolloutStorage
+from rsl_rl.utils import make_metrics_sink
+
+import genesis as gs
+
+
+def timeit(fn, device, repeats):
+    # one warm-up call, then the mean wall time per call in milliseconds
+    fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / repeats * 1e3
+
+
+class AllocationCounter(TorchDispatchMode):
+    """Counts op outputs that own fresh storage; views, in-place and out= results alias an input and are free."""
+
+    def __init__(self):
+        super().__init__()
+        self.phase = "step"
+        self.counts = defaultdict(int)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for ret in func._schema.returns:
+            if ret.alias_info is None and str(ret.type).startswith("Tensor"):
+                self.counts[self.phase] += 1
+        return out
+
+    def track(self, obj, method_names):
+        # attribute allocations made inside obj.<method> to that method
+        for name in method_names:
+            self.counts[name] += 0
+
+            def tracked(*args, _method=getattr(obj, name), _name=name, **kwargs):
+                outer, self.phase = self.phase, _name
+                try:
+                    return _method(*args, **kwargs)
+                finally:
+                    self.phase = outer
+            setattr(obj, name, tracked)
+
+
+def make_env(args, num_envs=None, **env_overrides):
+    env_cfg, obs_cfg, reward_cfg, command_cfg = get_cfgs()
+    env_cfg.update(env_overrides)
+    reward_cfg["reward_scales"] = dict(get_reward_scales(args.exp_name))
+    return KickerEnv(
+        num_envs=num_envs or args.num_envs,
+        env_cfg=env_cfg,
+        obs_cfg=obs_cfg,
+        reward_cfg=reward_cfg,
+        command_cfg=command_cfg,
+        device=args.device,
+    )
+
+
+def bench_reset(args):
+    env = make_env(args)
+    env.reset()
+    print(f"{'envs reset':>12} {'random_reset [ms]':>18} {'reset_idx [ms]':>16}")
+    n = 1
+    while n <= env.num_envs:
+        envs_idx = torch.randperm(env.num_envs, device=env.device)[:n]
+        ball_ms = timeit(lambda: env.random_reset(envs_idx), env.device, args.repeats)
+        reset_ms = timeit(lambda: env.reset_idx(envs_idx), env.device, args.repeats)
+        print(f"{n:>12d} {ball_ms:>18.3f} {reset_ms:>16.3f}")
+        n *= 4
+
+
+def bench_alloc(args):
+    env = make_env(args)
+    env.reset()
+    actions = torch.zeros((env.num_envs, env.num_actions), device=env.device)
+    # let the robots settle so that the measured steps are steady-state (no resets)
+    for _ in range(args.warmup):
+        env.step(actions)
+
+    counter = AllocationCounter()
+    counter.track(env, ["_update_state", "_check_termination", "reset_idx", "_compute_reward", "_compute_observations"])
+    with counter:
+        for _ in range(args.repeats):
+            env.step(actions)
+    step_ms = timeit(lambda: env.step(actions), env.device, args.repeats)
+
+    print(f"{'phase':>24} {'allocations/step':>18}")
+    for phase, count in sorted(counter.counts.items()):
+        print(f"{phase:>24} {count / args.repeats:>18.1f}")
+    print(f"{'step time [ms]':>24} {step_ms:>18.3f}")
+
+
+def bench_rewards(args):
+    env = make_env(args)
+    env.reset()
+    actions = torch.zeros((env.num_envs, env.num_actions), device=env.device)
+    for _ in range(args.warmup):
+        env.step(actions)
+
+    for stage in ("stand", "step", "kicker_v1"):
+        engine = RewardEngine(env, get_reward_scales(stage))
+        compiled = RewardEngine(env, get_reward_scales(stage), compile=True)
+        print(f"--- {stage} ---")
+        for name, cost in engine.profile(args.repeats).items():
+            print(f"{name:>24} {cost:>10.3f} ms")
+        eager_ms = timeit(lambda: engine.compute(env.rew_buf), env.device, args.repeats)
+        compiled_ms = timeit(lambda: compiled.compute(env.rew_buf), env.device, args.repeats)
+        print(f"{'total (eager)':>24} {eager_ms:>10.3f} ms")
+        print(f"{'total (compiled)':>24} {compiled_ms:>10.3f} ms")
+
+
+def bench_decimation(args):
+    current_dir = os.path.dirname(__file__)
+    for decimation in (1, 2, 4):
+        env = make_env(args, decimation=decimation)
+        env.reset()
+        actions = torch.zeros((env.num_envs, env.num_actions), device=env.device)
+        step_ms = timeit(lambda: env.step(actions), env.device, args.repeats)
+        print(
+            f"decimation {decimation}: {env.num_envs / step_ms * 1e3:.0f} policy steps/s, "
+            f"{env.num_envs * env.dt / step_ms * 1e3:.1f} simulated s/s"
+        )
+        if args.iterations > 0:
+            # learning curves land in TensorBoard; compare Train/mean_reward/time across runs
+            log_dir = os.path.join(current_dir, f"../logs/bench_decimation/{args.exp_name}_decimation_{decimation}")
+            os.makedirs(log_dir, exist_ok=True)
+            runner = OnPolicyRunner(env, get_train_cfg(args.exp_name, args.iterations), log_dir, device=args.device)
+            runner.learn(num_learning_iterations=args.iterations, init_at_random_ep_len=True)
+
+
+def bench_resets(args):
+    env = make_env(args)
+    env.reset()
+    actions = torch.zeros((env.num_envs, env.num_actions), device=env.device)
+
+    # force terminations at a controlled per-step rate on top of the regular termination checks
+    check_termination = env._check_termination
+    termination_rate = 0.0
+
+    def check_termination_at_rate():
+        check_termination()
+        env.reset_buf |= torch.rand(env.num_envs, device=env.device) < termination_rate
+
+    env._check_termination = check_termination_at_rate
+
+    print(f"{'termination rate':>18} {'flush interval':>16} {'env steps/s':>14}")
+    for termination_rate in (0.001, 0.005, 0.02):
+        for interval in (1, 4, 16):
+            env.reset_flush_interval = interval
+            step_ms = timeit(lambda: env.step(actions), env.device, args.repeats)
+            print(f"{termination_rate:>18.3f} {interval:>16d} {env.num_envs / step_ms * 1e3:>14.0f}")
+
+
+def bench_pool(args):
+    print(f"{'pool size':>10} {'reset_idx [ms]':>16} {'steps to first termination':>28}")
+    for pool_size in (0, args.num_envs):
+        env = make_env(args, reset_pool_size=pool_size)
+        env.reset()
+        all_envs = torch.arange(env.num_envs, device=env.device)
+        reset_ms = timeit(lambda: env.reset_idx(all_envs), env.device, args.repeats)
+
+        # hold the default pose and record how long each env survives its first episode
+        env.reset()
+        actions = torch.zeros((env.num_envs, env.num_actions), device=env.device)
+        survived = torch.zeros(env.num_envs, device=env.device)
+        alive = torch.ones(env.num_envs, device=env.device, dtype=torch.bool)
+        for _ in range(env.max_episode_length):
+            _, _, _, dones, _ = env.step(actions)
+            alive &= ~dones
+            survived += alive
+        print(f"{pool_size:>10d} {reset_ms:>16.3f} {survived.mean().item():>28.1f}")
+
+
+def bench_model(args):
+    # same seeds and the same open-loop actions on the full-mesh and the simplified-collision model
+    rollouts = []
+    for simplified in (False, True):
+        start = time.perf_counter()
+        env = make_env(args, simplified_collision=simplified)
+        build_s = time.perf_counter() - start
+        env.reset()
+        actions = torch.zeros((env.num_envs, env.num_actions), device=env.device)
+        step_ms = timeit(lambda: env.step(actions), env.device, args.repeats)
+        print(f"{'simplified' if simplified else 'full mesh':>12}: {env.num_envs / step_ms * 1e3:.0f} env steps/s, "
+              f"built in {build_s:.1f} s")
+
+        env.reset()
+        generator = torch.Generator(device=env.device).manual_seed(0)
+        alive = torch.ones(env.num_envs, device=env.device, dtype=torch.bool)
+        rollout = []
+        for _ in range(args.iterations):
+            actions = 0.3 * torch.randn(actions.shape, device=env.device, generator=generator)
+            _, _, _, dones, _ = env.step(actions)
+            alive &= ~dones
+            rollout.append((env.base_pos.clone(), env.dof_pos.clone(), alive.clone()))
+        rollouts.append(rollout)
+
+    # divergence over the envs that are still in their first episode in both rollouts
+    print(f"{'step':>6} {'base pos [m]':>14} {'dof pos [rad]':>14} {'alive (full/simple)':>20}")
+    for step in range(0, args.iterations, max(1, args.iterations // 10)):
+        (base_a, dof_a, alive_a), (base_b, dof_b, alive_b) = rollouts[0][step], rollouts[1][step]
+        live = alive_a & alive_b
+        base_err = torch.norm(base_a - base_b, dim=-1)[live].mean().item()
+        dof_err = torch.sqrt(torch.square(dof_a - dof_b).mean(dim=-1))[live].mean().item()
+        print(f"{step + 1:>6d} {base_err:>14.4f} {dof_err:>14.4f} "
+              f"{alive_a.float().mean().item():>14.2f}/{alive_b.float().mean().item():.2f}")
+
+
+def bench_gae(args):
+    # the step loop of RolloutStorage.compute_returns against the compiled kernel (compile_gae)
+    device = torch.device(args.device)
+    print(f"{'T':>5} {'N':>7} {'loop [ms]':>11} {'compiled [ms]':>14} {'compile [s]':>12}")
+    for num_steps in (24, 64, 256):
+        for num_envs in (512, 4096, 16384):
+            storages = [RolloutStorage(num_envs, num_steps, [1], [None], [1], device=device, compile_gae=compile_gae)
+                        for compile_gae in (False, True)]
+            loop, compiled = storages
+            loop.rewards.normal_()
+            loop.values.normal_()
+            loop.dones.copy_(torch.rand(loop.dones.shape, device=device) < 0.02)
+            compiled.data.copy_(loop.data)
+            compiled.rewards.copy_(loop.rewards)
+            compiled.dones.copy_(loop.dones)
+            last_values = torch.randn(num_envs, 1, device=device)
+
+            torch._dynamo.reset()  # one rollout shape per training run, a fresh compile per shape here
+            start = time.perf_counter()
+            compiled.compute_returns(last_values, 0.99, 0.95)
+            synchronize(device)
+            compile_s = time.perf_counter() - start
+            loop_ms = timeit(lambda: loop.compute_returns(last_values, 0.99, 0.95), device, args.repeats)
+            compiled_ms = timeit(lambda: compiled.compute_returns(last_values, 0.99, 0.95), device, args.repeats)
+            print(f"{num_steps:>5d} {num_envs:>7d} {loop_ms:>11.3f} {compiled_ms:>14.3f} {compile_s:>12.1f}")
+
+
+def reference_mini_batches(storage, num_mini_batches, num_epochs):
+    # the previous layout: every field flattened and gathered separately for every minibatch
+    mini_batch_size = storage.num_envs * storage.num_transitions_per_env // num_mini_batches
+    indices = torch.randperm(num_mini_batches * mini_batch_size, device=storage.device)
+    fields = [storage.observations, storage.actions, storage.values, storage.returns, storage.actions_log_prob,
+              storage.advantages, storage.mu, storage.sigma]
+    fields = [field.flatten(0, 1) for field in fields]
+    for epoch in range(num_epochs):
+        for i in range(num_mini_batches):
+            batch_idx = indices[i * mini_batch_size:(i + 1) * mini_batch_size]
+            yield [field[batch_idx] for field in fields]
+
+
+def bench_minibatch(args):
+    device = torch.device(args.device)
+    env_cfg, obs_cfg, _, _ = get_cfgs()
+    train_cfg = get_train_cfg(args.exp_name, 0)
+    num_steps = train_cfg["runner"]["num_steps_per_env"]
+    num_epochs = train_cfg["algorithm"]["num_learning_epochs"]
+    num_mini_batches = train_cfg["algorithm"]["num_mini_batches"]
+    storage = RolloutStorage(
+        args.num_envs, num_steps, [obs_cfg["num_obs"]], [None], [env_cfg["num_actions"]], device=device)
+    storage.data.normal_()
+
+    def consume(generator):
+        for batch in generator:
+            batch[0].sum()
+
+    reference_ms = timeit(lambda: consume(reference_mini_batches(storage, num_mini_batches, num_epochs)),
+                          device, args.repeats)
+    packed_ms = timeit(lambda: consume(storage.mini_batch_generator(num_mini_batches, num_epochs)),
+                       device, args.repeats)
+    print(f"T={num_steps} N={args.num_envs}, {num_epochs} epochs x {num_mini_batches} minibatches")
+    print(f"{'per-field gathers':>20}: {reference_ms:.3f} ms")
+    print(f"{'packed buffer':>20}: {packed_ms:.3f} ms")
+
+
+def make_ppo(args, actor_critic_class=ActorCritic, **alg_overrides):
+    # PPO of the train config on synthetic observations, without building a scene
+    env_cfg, obs_cfg, _, _ = get_cfgs()
+    train_cfg = get_train_cfg(args.exp_name, 0)
+    num_obs, num_actions = obs_cfg["num_obs"], env_cfg["num_actions"]
+    actor_critic = actor_critic_class(num_obs, num_obs, num_actions, **train_cfg["policy"]).to(args.device)
+    alg = PPO(actor_critic, device=args.device, **dict(train_cfg["algorithm"], **alg_overrides))
+    alg.init_storage(args.num_envs, train_cfg["runner"]["num_steps_per_env"], [num_obs], [None], [num_actions])
+    return alg
+
+
+def bench_rollout(args):
+    # the algorithm side of one rollout step: PPO.act + PPO.process_env_step
+    print(f"{'write_through':>14} {'allocations/step':>18} {'step time [ms]':>16}")
+    for write_through in (False, True):
+        alg = make_ppo(args, write_through=write_through)
+        obs = torch.randn(args.num_envs, alg.storage.observations.shape[-1], device=args.device)
+        rewards = torch.randn(args.num_envs, device=args.device)
+        dones = torch.zeros(args.num_envs, device=args.device, dtype=torch.bool)
+        infos = {"time_outs": torch.zeros(args.num_envs, device=args.device)}
+
+        def rollout_step():
+            if alg.storage.step == alg.storage.num_transitions_per_env:
+                alg.storage.clear()
+            alg.act(obs, obs)
+            alg.process_env_step(rewards, dones, infos)
+
+        with torch.inference_mode():
+            counter = AllocationCounter()
+            with counter:
+                for _ in range(args.repeats):
+                    rollout_step()
+            step_ms = timeit(rollout_step, torch.device(args.device), args.repeats)
+        print(f"{str(write_through):>14} {counter.counts['step'] / args.repeats:>18.1f} {step_ms:>16.3f}")
+
+
+def bench_act(args):
+    env_cfg, obs_cfg, _, _ = get_cfgs()
+    train_cfg = get_train_cfg(args.exp_name, 0)
+    num_obs, num_actions = obs_cfg["num_obs"], env_cfg["num_actions"]
+    device = torch.device(args.device)
+    eager = ActorCritic(num_obs, num_obs, num_actions, **train_cfg["policy"]).to(device)
+    compiled = ActorCritic(num_obs, num_obs, num_actions, compile_rollout=True, **train_cfg["policy"]).to(device)
+    compiled.load_state_dict(eager.state_dict())
+    obs = torch.randn(args.num_envs, num_obs, device=device)
+    outputs = [torch.empty(args.num_envs, size, device=device) for size in (num_actions, 1, 1, num_actions, num_actions)]
+
+    def separate():
+        actions = eager.act(obs)
+        return actions, eager.evaluate(obs), eager.get_actions_log_prob(actions)
+
+    with torch.inference_mode():
+        separate_ms = timeit(separate, device, args.repeats)
+        fused_ms = timeit(lambda: eager.act_rollout(obs, obs), device, args.repeats)
+        compiled_ms = timeit(lambda: compiled.act_into(obs, obs, *outputs), device, args.repeats)
+    print(f"{'act + evaluate + log_prob':>26}: {separate_ms:.3f} ms")
+    print(f"{'act_rollout':>26}: {fused_ms:.3f} ms")
+    print(f"{'act_into (compiled)':>26}: {compiled_ms:.3f} ms")
+
+
+def bench_head(args):
+    # cost of the DiagGaussian head against the torch.distributions.Normal path (tests/test_actor_critic.py checks
+    # that both agree)
+    env_cfg, obs_cfg, _, _ = get_cfgs()
+    train_cfg = get_train_cfg(args.exp_name, 0)
+    num_obs, num_actions = obs_cfg["num_obs"], env_cfg["num_actions"]
+    device = torch.device(args.device)
+    heads = {
+        "Normal": ActorCritic(num_obs, num_obs, num_actions, **train_cfg["policy"]).to(device),
+        "DiagGaussian": ActorCritic(num_obs, num_obs, num_actions, diag_gaussian=True, **train_cfg["policy"]).to(device),
+    }
+    with torch.no_grad():
+        heads["Normal"].std.uniform_(-1.0, 0.5)
+    heads["DiagGaussian"].load_state_dict(heads["Normal"].state_dict())
+    obs = torch.randn(args.num_envs, num_obs, device=device)
+    old_mu = torch.randn(args.num_envs, num_actions, device=device)
+    old_sigma = torch.rand(args.num_envs, num_actions, device=device) + 0.1
+
+    def loss_step(actor_critic, actions):
+        # the distribution part of a PPO minibatch: log-prob, entropy and KL, then the backward pass
+        actor_critic.act(obs)
+        log_prob = actor_critic.get_actions_log_prob(actions)
+        loss = -log_prob.mean() - 0.01 * actor_critic.entropy.mean()
+        with torch.no_grad():
+            kl = actor_critic.kl(old_mu, old_sigma)
+        loss.backward()
+        return log_prob.detach(), actor_critic.entropy.detach(), kl
+
+    for name, actor_critic in heads.items():
+        actions = actor_critic.act(obs).detach()
+        step_ms = timeit(lambda: loss_step(actor_critic, actions), device, args.repeats)
+        print(f"{name:>14}: {step_ms:.3f} ms")
+
+
+def fill_storage(alg, args):
+    # one synthetic rollout with returns, so that update() runs on realistic storage contents
+    num_obs = alg.storage.observations.shape[-1]
+    with torch.inference_mode():
+        for _ in range(alg.storage.num_transitions_per_env):
+            obs = torch.randn(args.num_envs, num_obs, device=args.device)
+            alg.act(obs, obs)
+            alg.process_env_step(torch.randn(args.num_envs, device=args.device),
+                                 torch.rand(args.num_envs, device=args.device) < 0.01, dict())
+        alg.compute_returns(torch.randn(args.num_envs, num_obs, device=args.device))
+
+
+def bench_update(args):
+    # PPO.update variants from the same weights and rollout: eager with per-minibatch host syncs, sync-free, compiled
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    reference = make_ppo(args)
+    fill_storage(reference, args)
+    weights = copy.deepcopy(reference.actor_critic.state_dict())
+    data = reference.storage.data.clone()
+
+    variants = {
+        "eager": dict(),
+        "sync_free": dict(sync_free_update=True),
+        "compiled": dict(compile_update=True),
+        "compiled+sync_free": dict(compile_update=True, sync_free_update=True),
+    }
+    print(f"{'variant':>18} {'update [ms]':>12} {'value loss':>12} {'surrogate':>12} {'lr':>10}")
+    for name, overrides in variants.items():
+        alg = make_ppo(args, **overrides)
+        alg.actor_critic.load_state_dict(weights)
+
+        def update():
+            alg.storage.data.copy_(data)
+            return alg.update()
+
+        losses = update()
+        learning_rate = alg.learning_rate
+        update_ms = timeit(update, device, args.repeats)
+        print(f"{name:>18} {update_ms:>12.1f} {losses[0]:>12.5f} {losses[1]:>12.5f} {learning_rate:>10.2e}")
+
+
+def bench_precision(args):
+    # rollout step and update under fp32 and autocast, from the same weights and rollout
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    reference = make_ppo(args)
+    fill_storage(reference, args)
+    weights = copy.deepcopy(reference.actor_critic.state_dict())
+    data = reference.storage.data.clone()
+    obs = torch.randn(args.num_envs, reference.storage.observations.shape[-1], device=device)
+    rewards = torch.randn(args.num_envs, device=device)
+    dones = torch.zeros(args.num_envs, device=device, dtype=torch.bool)
+
+    print(f"{'precision':>10} {'step [ms]':>10} {'update [ms]':>12} {'value loss':>12} {'surrogate':>12}")
+    for precision in (None, "bf16", "fp16"):
+        alg = make_ppo(args, mixed_precision=precision)
+        alg.actor_critic.load_state_dict(weights)
+
+        def rollout_step():
+            if alg.storage.step == alg.storage.num_transitions_per_env:
+                alg.storage.clear()
+            alg.act(obs, obs)
+            alg.process_env_step(rewards, dones, dict())
+
+        def update():
+            alg.storage.data.copy_(data)
+            return alg.update()
+
+        with torch.inference_mode():
+            step_ms = timeit(rollout_step, device, args.repeats)
+        losses = update()
+        update_ms = timeit(update, device, max(1, args.repeats // 20))
+        print(f"{str(precision):>10} {step_ms:>10.3f} {update_ms:>12.1f} {losses[0]:>12.5f} {losses[1]:>12.5f}")
+
+    if args.iterations > 0:
+        # learning-curve parity: compare Train/mean_reward across the runs in TensorBoard
+        current_dir = os.path.dirname(__file__)
+        for precision in (None, "bf16"):
+            torch.manual_seed(0)
+            env = make_env(args)
+            train_cfg = get_train_cfg(args.exp_name, args.iterations)
+            train_cfg["algorithm"]["mixed_precision"] = precision
+            log_dir = os.path.join(current_dir, f"../logs/bench_precision/{args.exp_name}_{precision or 'fp32'}")
+            os.makedirs(log_dir, exist_ok=True)
+            runner = OnPolicyRunner(env, train_cfg, log_dir, device=args.device)
+            runner.learn(num_learning_iterations=args.iterations, init_at_random_ep_len=True)
+
+
+def bench_storage(args):
+    # memory per field of the rollout storage and the update on it, for fp32 and compressed storage
+    device = torch.device(args.device)
+    usages, rows = dict(), []
+    for storage_dtype in (None, "bf16", "fp16"):
+        torch.manual_seed(0)
+        alg = make_ppo(args, storage_dtype=storage_dtype)
+        fill_storage(alg, args)
+        data = [buffer.clone() for buffer in (alg.storage.data, alg.storage.compressed_data) if buffer is not None]
+
+        def update():
+            for buffer, saved in zip((alg.storage.data, alg.storage.compressed_data), data):
+                buffer.copy_(saved)
+            return alg.update()
+
+        losses = update()
+        update_ms = timeit(update, device, args.repeats)
+        usages[str(storage_dtype)] = alg.storage.memory_usage()
+        rows.append((str(storage_dtype), update_ms) + losses)
+
+    names = list(dict.fromkeys(name for usage in usages.values() for name in usage))
+    print(f"{'field [MB]':>24}" + "".join(f"{dtype:>10}" for dtype in usages))
+    for name in names + ["total"]:
+        values = [usage.get(name, 0) if name != "total" else sum(usage.values()) for usage in usages.values()]
+        print(f"{name:>24}" + "".join(f"{value / 2 ** 20:>10.1f}" for value in values))
+    print(f"{'storage':>10} {'update [ms]':>12} {'value loss':>12} {'surrogate':>12}")
+    for dtype, update_ms, value_loss, surrogate_loss in rows:
+        print(f"{dtype:>10} {update_ms:>12.1f} {value_loss:>12.5f} {surrogate_loss:>12.5f}")
+
+
+def reference_recurrent_mini_batches(storage, num_mini_batches, num_epochs):
+    # the previous generator: host-side trajectory split, and done masks and hidden-state gathers per minibatch
+    # (with the critic hidden states taken from memory_c, which it mixed up with memory_a for LSTMs)
+    dones = storage.dones.clone()
+    dones[-1] = 1
+    flat_dones = dones.transpose(1, 0).reshape(-1, 1)
+    done_indices = torch.cat((flat_dones.new_tensor([-1], dtype=torch.int64), flat_dones.nonzero()[:, 0]))
+    trajectory_lengths = done_indices[1:] - done_indices[:-1]
+    trajectories = torch.split(storage.observations.transpose(1, 0).flatten(0, 1), trajectory_lengths.tolist())
+    padded_obs = torch.nn.utils.rnn.pad_sequence(trajectories)
+    masks = trajectory_lengths > torch.arange(0, storage.num_transitions_per_env, device=storage.device).unsqueeze(1)
+
+    mini_batch_size = storage.num_envs // num_mini_batches
+    for epoch in range(num_epochs):
+        first_traj = 0
+        for i in range(num_mini_batches):
+            start, stop = i * mini_batch_size, (i + 1) * mini_batch_size
+            dones = storage.dones.squeeze(-1)
+            last_was_done = torch.zeros_like(dones, dtype=torch.bool)
+            last_was_done[1:] = dones[:-1]
+            last_was_done[0] = True
+            last_traj = first_traj + torch.sum(last_was_done[:, start:stop])
+            last_was_done = last_was_done.permute(1, 0)
+            hid_a = [saved.permute(2, 0, 1, 3)[last_was_done][first_traj:last_traj].transpose(1, 0).contiguous()
+                     for saved in storage.saved_hidden_states_a]
+            hid_c = [saved.permute(2, 0, 1, 3)[last_was_done][first_traj:last_traj].transpose(1, 0).contiguous()
+                     for saved in storage.saved_hidden_states_c]
+            hid_a = hid_a[0] if len(hid_a) == 1 else hid_a
+            hid_c = hid_c[0] if len(hid_c) == 1 else hid_c
+            obs_batch = padded_obs[:, first_traj:last_traj]
+            yield obs_batch, obs_batch, storage.actions[:, start:stop], storage.values[:, start:stop], \
+                storage.advantages[:, start:stop], storage.returns[:, start:stop], \
+                storage.actions_log_prob[:, start:stop], storage.mu[:, start:stop], storage.sigma[:, start:stop], \
+                (hid_a, hid_c), masks[:, first_traj:last_traj], None
+            first_traj = last_traj
+
+
+def bench_recurrent(args):
+    # ActorCriticRecurrent update with the previous and the precomputed recurrent minibatch generator (tests/
+    # test_rollout_storage.py checks that both yield the same minibatches)
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    alg = make_ppo(args, actor_critic_class=ActorCriticRecurrent)
+    fill_storage(alg, args)
+    storage = alg.storage
+    num_epochs, num_mini_batches = alg.num_learning_epochs, alg.num_mini_batches
+    print(f"T={storage.num_transitions_per_env} N={args.num_envs}, {num_epochs} epochs x {num_mini_batches} minibatches")
+
+    weights = copy.deepcopy(alg.actor_critic.state_dict())
+    data = storage.data.clone()
+    generators = {
+        "previous": lambda num_mini_batches, num_epochs: reference_recurrent_mini_batches(storage, num_mini_batches, num_epochs),
+        "precomputed": storage.reccurent_mini_batch_generator,
+    }
+    for name, generator in generators.items():
+        generator_ms = timeit(lambda: sum(1 for _ in generator(num_mini_batches, num_epochs)), device, args.repeats)
+        alg.actor_critic.load_state_dict(weights)
+        storage.reccurent_mini_batch_generator = generator
+
+        def update():
+            storage.data.copy_(data)
+            return alg.update()
+
+        update_ms = timeit(update, device, max(1, args.repeats // 20))
+        print(f"{name:>12}: generator {generator_ms:.1f} ms, update {update_ms:.1f} ms")
+    del storage.reccurent_mini_batch_generator
+
+
+def resume_runs(args, log_root, iterations):
+    # one uninterrupted run and two runs resumed from its checkpoint halfway; yields the name, the seconds spent
+    # loading and learning, and the final weights and env state of every run
+    half = iterations // 2
+    for run in ("uninterrupted", "resumed", "resumed again"):
+        torch.manual_seed(0)
+        env = make_env(args)
+        train_cfg = get_train_cfg(args.exp_name, iterations)
+        train_cfg["runner"]["save_interval"] = half
+        train_cfg["runner"]["save_env_state"] = "always"
+        log_dir = os.path.join(log_root, f"{args.exp_name}_{run.replace(' ', '_')}")
+        os.makedirs(log_dir, exist_ok=True)
+        runner = OnPolicyRunner(env, train_cfg, log_dir, device=args.device)
+        start = time.perf_counter()
+        if run == "uninterrupted":
+            checkpoint = os.path.join(log_dir, f"model_{half}.pt")
+            load_s = 0.0
+            runner.learn(num_learning_iterations=iterations, init_at_random_ep_len=True)
+        else:
+            runner.load(checkpoint, load_training_state=True)
+            load_s = time.perf_counter() - start
+            runner.learn(num_learning_iterations=iterations - runner.current_learning_iteration)
+        learn_s = time.perf_counter() - start - load_s
+        yield run, load_s, learn_s, torch.cat([value.flatten().float().cpu() for value in (
+            *runner.alg.actor_critic.state_dict().values(), env.obs_buf, env.episode_length_buf)])
+
+
+def bench_resume(args):
+    # cost of resuming from a checkpoint with the full training state (tests/test_resume.py checks that the resumed
+    # runs end up identical to the uninterrupted one)
+    log_root = os.path.join(os.path.dirname(__file__), "../logs/bench_resume")
+    print(f"{'run':>16} {'load [ms]':>10} {'learn [s]':>10}")
+    for run, load_s, learn_s, _ in resume_runs(args, log_root, max(args.iterations, 4)):
+        print(f"{run:>16} {load_s * 1e3:>10.1f} {learn_s:>10.1f}")
+
+
+def bench_metrics(args):
+    # training-thread cost of one iteration of metrics: ~20 scalars and the two episode histograms
+    current_dir = os.path.dirname(__file__)
+    scalars = {f"Bench/scalar_{i}": float(i) for i in range(20)}
+    histograms = {"Bench/returns": torch.randn(100), "Bench/lengths": torch.rand(100)}
+    print(f"{'backend':>12} {'write [ms]':>11} {'flush [ms]':>11}")
+    for backend in ("null", "tensorboard", "columnar"):
+        log_dir = os.path.join(current_dir, f"../logs/bench_metrics/{backend}")
+        os.makedirs(log_dir, exist_ok=True)
+        sink = make_metrics_sink(backend, log_dir)
+        step = iter(range(10 ** 9))
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            sink.write(next(step), scalars, histograms)
+        write_ms = (time.perf_counter() - start) / args.repeats * 1e3
+        start = time.perf_counter()
+        sink.close()
+        flush_ms = (time.perf_counter() - start) * 1e3
+        print(f"{backend:>12} {write_ms:>11.4f} {flush_ms:>11.1f}")
+
+
+BENCHMARKS = {
+    "reset": bench_reset,
+    "alloc": bench_alloc,
+    "rewards": bench_rewards,
+    "decimation": bench_decimation,
+    "resets": bench_resets,
+    "pool": bench_pool,
+    "model": bench_model,
+    "gae": bench_gae,
+    "minibatch": bench_minibatch,
+    "rollout": bench_rollout,
+    "act": bench_act,
+    "head": bench_head,
+    "update": bench_update,
+    "precision": bench_precision,
+    "storage": bench_storage,
+    "recurrent": bench_recurrent,
+    "resume": bench_resume,
+    "metrics": bench_metrics,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=list(BENCHMARKS.keys()))
+    parser.add_argument("-e", "--exp_name", type=str, default="kicker_v1")
+    parser.add_argument("-B", "--num_envs", type=int, default=2048)
+    parser.add_argument("-d", "--device", type=str, default="mps")
+    parser.add_argument("--repeats", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=0, help="Learning iterations per run, 0 to skip")
+    args = parser.parse_args()
+
+    gs.init(backend=gs.cpu if args.device == "cpu" else gs.gpu, logging_level="warning")
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
+
+"""
+# benchmarks
+python src/benchmark.py reset -B 2048 --repeats 100
+python src/benchmark.py alloc -B 2048
+python src/benchmark.py rewards -B 2048
+python src/benchmark.py decimation -e stand -B 2048 --iterations 300
+python src/benchmark.py resets -B 2048
+python src/benchmark.py pool -e stand -B 2048
+python src/benchmark.py model -B 2048 --iterations 100
+python src/benchmark.py gae -d cuda
+python src/benchmark.py minibatch -B 4096
+python src/benchmark.py rollout -B 4096
+python src/benchmark.py act -B 4096 -d cuda
+python src/benchmark.py head -B 4096
+python src/benchmark.py update -B 4096 --repeats 5 -d cuda
+python src/benchmark.py update -B 256 --repeats 3 -d cpu
+python src/benchmark.py precision -e stand -B 4096 -d cuda --iterations 300
+python src/benchmark.py storage -B 16384 --repeats 3 -d cuda
+python src/benchmark.py recurrent -B 4096 --repeats 20 -d cuda
+python src/benchmark.py resume -e stand -B 256 -d cpu --iterations 10
+python src/benchmark.py metrics --repeats 1000
+
+# correctness checks of the optimized paths (CPU)
+python -m pytest -q src/tests
+"""
@@ -1,14 +1,17 @@
 import os
 import torch
 import math
-import random
 import numpy as np
 import genesis as gs
-from genesis.utils.geom import quat_to_xyz, transform_by_quat, inv_quat, transform_quat_by_quat
+from genesis.utils.geom import quat_to_xyz, transform_by_quat, inv_quat, transform_quat_by_quat, xyz_to_quat
 
+from rewards import RewardEngine
+from reset_pool import ResetStatePool
+from rsl_rl.utils import phase
 
-def gs_rand_float(lower, upper, shape, device):
-    return (upper - lower) * torch.rand(size=shape, device=device) + lower
+
+def gs_rand_float(lower, upper, shape, device, generator=None):
+    return (upper - lower) * torch.rand(size=shape, device=device, generator=generator) + lower
 
 
 def run_sim(env, policy):
@@ -19,6 +22,30 @@ def run_sim(env, policy):
             obs, _, rews, dones, infos = env.step(actions)
 
 
+class SimState:
+    """Simulator readback for one step, filled once after scene.step() and shared by rewards and observations."""
+
+    def __init__(self, num_envs, num_dofs, device):
+        self.base_pos = torch.zeros((num_envs, 3), device=device, dtype=gs.tc_float)
+        self.base_quat = torch.zeros((num_envs, 4), device=device, dtype=gs.tc_float)
+        self.base_vel = torch.zeros((num_envs, 3), device=device, dtype=gs.tc_float)  # world frame
+        self.base_ang = torch.zeros((num_envs, 3), device=device, dtype=gs.tc_float)  # world frame
+        self.dof_pos = torch.zeros((num_envs, num_dofs), device=device, dtype=gs.tc_float)
+        self.dof_vel = torch.zeros((num_envs, num_dofs), device=device, dtype=gs.tc_float)
+        self.ball_pos = torch.zeros((num_envs, 3), device=device, dtype=gs.tc_float)
+        self.ball_vel = torch.zeros((num_envs, 3), device=device, dtype=gs.tc_float)
+
+    def update(self, robot, ball, motor_dofs):
+        self.base_pos[:] = robot.get_pos()
+        self.base_quat[:] = robot.get_quat()
+        self.base_vel[:] = robot.get_vel()
+        self.base_ang[:] = robot.get_ang()
+        self.dof_pos[:] = robot.get_dofs_position(motor_dofs)
+        self.dof_vel[:] = robot.get_dofs_velocity(motor_dofs)
+        self.ball_pos[:] = ball.get_pos()
+        self.ball_vel[:] = ball.get_vel()
+
+
 class KickerEnv:
     def __init__(self, num_envs, env_cfg, obs_cfg, reward_cfg, command_cfg, show_viewer=False, device="mps", model_path="../model/g1.xml"):
         self.device = torch.device(device)
@@ -26,6 +53,17 @@ class KickerEnv:
         self.ball_position = torch.tensor([[0.2, -0.2, self.ball_radius]], device=self.device).cpu().numpy()
         self.target_size = (0.01, 1.0, 1.0)
         self.target_distance = 0.5
+        # the target is analytic, a per-env box center and size sampled on reset from these bounds
+        target_center = [self.target_distance, 0.0, self.target_size[2] / 2]
+        self.target_pos_lower = torch.tensor(env_cfg.get("target_pos_lower", target_center), device=self.device)
+        self.target_pos_upper = torch.tensor(env_cfg.get("target_pos_upper", target_center), device=self.device)
+        self.target_size_lower = torch.tensor(env_cfg.get("target_size_lower", self.target_size), device=self.device)
+        self.target_size_upper = torch.tensor(env_cfg.get("target_size_upper", self.target_size), device=self.device)
+        self.randomize_target = not (torch.equal(self.target_pos_lower, self.target_pos_upper)
+                                     and torch.equal(self.target_size_lower, self.target_size_upper))
+        # ball spawn box (x, y, z), sampled per env on reset
+        self.ball_pos_lower = torch.tensor([0.1, -0.16, self.ball_radius], device=self.device)
+        self.ball_pos_upper = torch.tensor([0.11, -0.15, self.ball_radius], device=self.device)
 
         self.num_envs = num_envs
         self.num_obs = obs_cfg["num_obs"]
@@ -33,8 +71,15 @@ class KickerEnv:
         self.num_actions = env_cfg["num_actions"]
         self.num_commands = command_cfg["num_commands"]
 
+        # seeded generator for on-device reset sampling
+        self.rng = torch.Generator(device=self.device)
+        self.rng.manual_seed(env_cfg.get("seed", 0))
+
         self.simulate_action_latency = True  # there is a 1 step latency on real robot
-        self.dt = 0.02  # control frequence on real robot is 50hz
+        self.sim_dt = 0.02  # control frequence on real robot is 50hz
+        # physics substeps per policy step; the PD target is held across them, the action latency stays one substep
+        self.decimation = env_cfg.get("decimation", 1)
+        self.dt = self.sim_dt * self.decimation  # policy step
         self.max_episode_length = math.ceil(env_cfg["episode_length_s"] / self.dt)
 
         self.env_cfg = env_cfg
@@ -47,10 +92,10 @@ class KickerEnv:
 
         # create scene
         self.scene = gs.Scene(
-            sim_options=gs.options.SimOptions(dt=self.dt, substeps=2),
+            sim_options=gs.options.SimOptions(dt=self.sim_dt, substeps=2),
             viewer_options=gs.options.ViewerOptions(
                 res=(1280, 960),
-                max_FPS=int(0.5 / self.dt),
+                max_FPS=int(0.5 / self.sim_dt),
                 camera_pos=(6, 3, 5),
                 camera_lookat=(-2.0, 3.0, 0.8),
                 camera_fov=60,
@@ -61,7 +106,7 @@ class KickerEnv:
                 n_rendered_envs=1
             ),
             rigid_options=gs.options.RigidOptions(
-                dt=self.dt,
+                dt=self.sim_dt,
                 constraint_solver=gs.constraint_solver.Newton,
                 enable_collision=True,
                 enable_joint_limit=True,
@@ -78,6 +123,9 @@ class KickerEnv:
         self.base_init_quat = torch.tensor(self.env_cfg["base_init_quat"], device=self.device)
         self.inv_base_init_quat = inv_quat(self.base_init_quat)
 
+        # primitive-collision variant from simplify_model.py, with the visual meshes only when they are drawn
+        if self.env_cfg.get("simplified_collision", False):
+            model_path = "../model/g1_train_vis.xml" if show_viewer else "../model/g1_train.xml"
         current_dir = os.path.dirname(__file__)
         robot_path = os.path.join(current_dir, model_path)
         self.robot = self.scene.add_entity(
@@ -95,20 +143,28 @@ class KickerEnv:
             ),
         )
 
-        self.target = self.scene.add_entity(
-            gs.morphs.Box(
-                size=self.target_size,
-                pos=(self.target_distance, 0, self.target_size[2] / 2),
-                collision=False,
-                fixed=True
-            ),
-        )
+        # only drawn in the viewer, where it follows the target of the rendered env
+        self.target = None
+        if show_viewer:
+            self.target = self.scene.add_entity(
+                gs.morphs.Box(
+                    size=self.target_size,
+                    pos=target_center,
+                    collision=False,
+                    fixed=True
+                ),
+            )
 
         # build
         self.scene.build(n_envs=num_envs)
 
         # names to indices
         self.motor_dofs = [self.robot.get_joint(name).dof_idx_local for name in self.env_cfg["dof_names"]]
+        self.motor_qs = [self.robot.get_joint(name).q_idx_local for name in self.env_cfg["dof_names"]]
+
+        # foot contact sensor: resolve the foot links once, refresh their contact state once per physics step
+        self.feet_links_idx = [self.robot.get_link(name).idx_local for name in self.env_cfg.get(
+            "feet_link_names", ["left_ankle_roll_link", "right_ankle_roll_link"])]
 
         # PD control parameters
         self.robot.set_dofs_kp([self.env_cfg["kp"]] * self.num_actions, self.motor_dofs)
@@ -121,12 +177,9 @@ class KickerEnv:
             dofs_idx_local=self.motor_dofs,
         )
 
-        # prepare reward functions and multiply reward scales by dt
-        self.reward_functions, self.episode_sums = dict(), dict()
-        for name in self.reward_scales.keys():
-            self.reward_scales[name] *= self.dt
-            self.reward_functions[name] = getattr(self, "_reward_" + name)
-            self.episode_sums[name] = torch.zeros((self.num_envs,), device=self.device, dtype=gs.tc_float)
+        # prepare the active (non-zero) reward terms, scaled by dt
+        self.reward_engine = RewardEngine(self, self.reward_scales, compile=self.env_cfg.get("compile_rewards", False))
+        self.track_foot_contacts = "foot_contact" in self.reward_engine.names or self.env_cfg.get("track_foot_contacts", False)
 
         # initialize buffers
         self.base_lin_vel = torch.zeros((self.num_envs, 3), device=self.device, dtype=gs.tc_float)
@@ -135,9 +188,21 @@ class KickerEnv:
         self.global_gravity = torch.tensor([0.0, 0.0, -10], device=self.device, dtype=gs.tc_float).repeat(
             self.num_envs, 1
         )
+        self.base_euler = torch.zeros((self.num_envs, 3), device=self.device, dtype=gs.tc_float)
+        self.inv_base_init_quats = self.inv_base_init_quat.repeat(self.num_envs, 1)
         self.obs_buf = torch.zeros((self.num_envs, self.num_obs), device=self.device, dtype=gs.tc_float)
         self.rew_buf = torch.zeros((self.num_envs,), device=self.device, dtype=gs.tc_float)
-        self.reset_buf = torch.ones((self.num_envs,), device=self.device, dtype=gs.tc_int)
+        self.reset_buf = torch.ones((self.num_envs,), device=self.device, dtype=torch.bool)
+        self.time_out_buf = torch.zeros((self.num_envs,), device=self.device, dtype=gs.tc_float)
+        self.termination_buf = torch.zeros((self.num_envs,), device=self.device, dtype=torch.bool)
+        self.tilt_buf = torch.zeros((self.num_envs, 2), device=self.device, dtype=gs.tc_float)
+        self.any_reset = torch.zeros((), device=self.device, dtype=torch.bool)
+        # deferred resets: flush every reset_flush_interval steps or once reset_flush_fraction of envs are pending
+        self.reset_flush_interval = self.env_cfg.get("reset_flush_interval", 1)
+        self.reset_flush_fraction = self.env_cfg.get("reset_flush_fraction", 1.0)
+        self.pending_resets = torch.zeros((self.num_envs,), device=self.device, dtype=torch.bool)
+        self.masked_envs = torch.zeros((self.num_envs,), device=self.device, dtype=torch.bool)
+        self.steps_since_flush = 0
         self.episode_length_buf = torch.zeros((self.num_envs,), device=self.device, dtype=gs.tc_int)
         self.commands = torch.zeros((self.num_envs, self.num_commands), device=self.device, dtype=gs.tc_float)
         self.commands_scale = torch.tensor(
@@ -145,19 +210,64 @@ class KickerEnv:
             device=self.device,
             dtype=gs.tc_float,
         )
+        self.resampling_steps = int(self.env_cfg["resampling_time_s"] / self.dt)
+        self.resampling_phase = torch.zeros_like(self.episode_length_buf)
+        self.resampling_mask = torch.zeros((self.num_envs,), device=self.device, dtype=torch.bool)
+        self.command_range_lower = torch.tensor(
+            [self.command_cfg[key][0] for key in ("lin_vel_x_range", "lin_vel_y_range", "ang_vel_range")],
+            device=self.device,
+            dtype=gs.tc_float,
+        )
+        self.command_range_span = torch.tensor(
+            [self.command_cfg[key][1] for key in ("lin_vel_x_range", "lin_vel_y_range", "ang_vel_range")],
+            device=self.device,
+            dtype=gs.tc_float,
+        ) - self.command_range_lower
+        self.command_samples = torch.zeros_like(self.commands)
         self.actions = torch.zeros((self.num_envs, self.num_actions), device=self.device, dtype=gs.tc_float)
+        self.target_dof_pos = torch.zeros_like(self.actions)
         self.last_actions = torch.zeros_like(self.actions)
-        self.dof_pos = torch.zeros_like(self.actions)
-        self.dof_vel = torch.zeros_like(self.actions)
         self.last_dof_vel = torch.zeros_like(self.actions)
-        self.base_pos = torch.zeros((self.num_envs, 3), device=self.device, dtype=gs.tc_float)
-        self.base_quat = torch.zeros((self.num_envs, 4), device=self.device, dtype=gs.tc_float)
+        # per-step simulator readback; the base and dof buffers below are views into it
+        self.state = SimState(self.num_envs, self.num_actions, self.device)
+        self.target_pos = self.target_pos_lower.repeat(self.num_envs, 1)
+        self.target_half_size = 0.5 * self.target_size_lower.repeat(self.num_envs, 1)
+        self.ball_hit_dist = torch.zeros_like(self.target_pos)
+        self.base_pos = self.state.base_pos
+        self.base_quat = self.state.base_quat
+        self.dof_pos = self.state.dof_pos
+        self.dof_vel = self.state.dof_vel
         self.default_dof_pos = torch.tensor(
             [self.env_cfg["default_joint_angles"][name] for name in self.env_cfg["dof_names"]],
             device=self.device,
             dtype=gs.tc_float,
         )
+        self.foot_contacts = torch.zeros((self.num_envs, len(self.feet_links_idx)), device=self.device, dtype=torch.bool)
+        # observation slices, written in place every step
+        obs_sizes = {
+            "ang_vel": 3,
+            "projected_gravity": 3,
+            "commands": self.num_commands,
+            "dof_pos": self.num_actions,
+            "dof_vel": self.num_actions,
+            "actions": self.num_actions,
+            "base_pos": 3,
+            "ball_pos": 3,
+            "target_pos": 3,
+        }
+        self.obs_views = dict(zip(obs_sizes.keys(), torch.split(self.obs_buf, list(obs_sizes.values()), dim=-1)))
         self.extras = dict()  # extra information for logging
+        self.extras["time_outs"] = self.time_out_buf
+        if self.reset_flush_interval > 1:
+            # only reported with deferred resets: the runner then drops the masked samples from the PPO batch
+            self.extras["masked_envs"] = self.masked_envs
+
+        # reset-state pool: reset_idx restores settled states instead of dropping the robot from base_init_pos
+        self.reset_pool = None
+        self.reset_pool_refresh_interval = self.env_cfg.get("reset_pool_refresh_interval", 100)
+        self.steps_since_refresh = 0
+        if self.env_cfg.get("reset_pool_size", 0) > 0:
+            self._fill_reset_pool(self.env_cfg["reset_pool_size"])
 
     def setup_sim(self, policy):
         gs.tools.run_in_another_thread(fn=run_sim, args=(self, policy))
@@ -168,12 +278,20 @@ class KickerEnv:
         self.commands[envs_idx, 1] = gs_rand_float(*self.command_cfg["lin_vel_y_range"], (len(envs_idx),), self.device)
         self.commands[envs_idx, 2] = gs_rand_float(*self.command_cfg["ang_vel_range"], (len(envs_idx),), self.device)
 
+    def _set_dof_targets(self, actions):
+        torch.mul(actions, self.env_cfg["action_scale"], out=self.target_dof_pos).add_(self.default_dof_pos)
+        self.robot.control_dofs_position(self.target_dof_pos, self.motor_dofs)
+
     def step(self, actions):
-        self.actions = torch.clip(actions, -self.env_cfg["clip_actions"], self.env_cfg["clip_actions"])
+        torch.clip(actions, -self.env_cfg["clip_actions"], self.env_cfg["clip_actions"], out=self.actions)
         exec_actions = self.last_actions if self.simulate_action_latency else self.actions
-        target_dof_pos = exec_actions * self.env_cfg["action_scale"] + self.default_dof_pos
-        self.robot.control_dofs_position(target_dof_pos, self.motor_dofs)
-        self.scene.step()
+        self._set_dof_targets(exec_actions)
+        with phase("env.scene_step"):
+            for substep in range(self.decimation):
+                if substep == 1 and self.simulate_action_latency:
+                    # the previous action only covers the first substep, the new one takes over after sim_dt
+                    self._set_dof_targets(self.actions)
+                self.scene.step()
 
         # cam_pose = self.scene.viewer.camera_pose
         # # move camera with the robot
@@ -184,67 +302,96 @@ class KickerEnv:
 
         # update buffers
         self.episode_length_buf += 1
-        self.base_pos[:] = self.robot.get_pos()
-        self.base_quat[:] = self.robot.get_quat()
-        self.base_euler = quat_to_xyz(
-            transform_quat_by_quat(torch.ones_like(self.base_quat) * self.inv_base_init_quat, self.base_quat)
-        )
-        inv_base_quat = inv_quat(self.base_quat)
-        self.base_lin_vel[:] = transform_by_quat(self.robot.get_vel(), inv_base_quat)
-        self.base_ang_vel[:] = transform_by_quat(self.robot.get_ang(), inv_base_quat)
-        self.projected_gravity = transform_by_quat(self.global_gravity, inv_base_quat)
-        self.dof_pos[:] = self.robot.get_dofs_position(self.motor_dofs)
-        self.dof_vel[:] = self.robot.get_dofs_velocity(self.motor_dofs)
+        with phase("env.readback"):
+            self._update_state()
 
         # resample commands
-        envs_idx = (
-            (self.episode_length_buf % int(self.env_cfg["resampling_time_s"] / self.dt) == 0)
-            .nonzero(as_tuple=False)
-            .flatten()
-        )
-        self._resample_commands(envs_idx)
+        torch.remainder(self.episode_length_buf, self.resampling_steps, out=self.resampling_phase)
+        torch.eq(self.resampling_phase, 0, out=self.resampling_mask)
+        torch.rand(self.command_samples.shape, out=self.command_samples)
+        self.command_samples.mul_(self.command_range_span).add_(self.command_range_lower)
+        torch.where(self.resampling_mask.unsqueeze(-1), self.command_samples, self.commands, out=self.commands)
 
         # check termination and reset
-        self.reset_buf = self.episode_length_buf > self.max_episode_length
-        self.reset_buf |= torch.abs(self.base_euler[:, 1]) > self.env_cfg["termination_if_pitch_greater_than"]
-        self.reset_buf |= torch.abs(self.base_euler[:, 0]) > self.env_cfg["termination_if_roll_greater_than"]
-        self.reset_buf |= self.base_pos[:, 2] < self.env_cfg.get("termination_base_height", 0.4)
+        with phase("env.resets"):
+            self._check_termination()
+            if self.reset_pool is not None and self.reset_pool_refresh_interval > 0:
+                self.steps_since_refresh += 1
+                if self.steps_since_refresh >= self.reset_pool_refresh_interval:
+                    self._refresh_reset_pool()
+                    self.steps_since_refresh = 0
+            if self.reset_flush_interval > 1:
+                self._defer_resets()
+            else:
+                torch.any(self.reset_buf, out=self.any_reset)
+                if self.any_reset:
+                    self.reset_idx(self.reset_buf.nonzero(as_tuple=False).flatten())
+
+        with phase("env.rewards"):
+            self._compute_reward()
+        with phase("env.observations"):
+            self._compute_observations()
+
+        self.last_actions.copy_(self.actions)
+        self.last_dof_vel.copy_(self.dof_vel)
 
-        # self.reset_buf |= self.is_ball_hit_target()
+        return self.obs_buf, None, self.rew_buf, self.reset_buf, self.extras
 
-        time_out_idx = (self.episode_length_buf > self.max_episode_length).nonzero(as_tuple=False).flatten()
-        self.extras["time_outs"] = torch.zeros_like(self.reset_buf, device=self.device, dtype=gs.tc_float)
-        self.extras["time_outs"][time_out_idx] = 1.0
-
-        self.reset_idx(self.reset_buf.nonzero(as_tuple=False).flatten())
-
-        # compute reward
-        self.rew_buf[:] = 0.0
-        for name, reward_func in self.reward_functions.items():
-            rew = reward_func() * self.reward_scales[name]
-            self.rew_buf += rew
-            self.episode_sums[name] += rew
-
-        # compute observations
-        self.obs_buf = torch.cat(
-            [
-                self.base_ang_vel * self.obs_scales["ang_vel"],  # 3
-                self.projected_gravity,  # 3
-                self.commands * self.commands_scale,  # 3
-                (self.dof_pos - self.default_dof_pos) * self.obs_scales["dof_pos"],  # 12
-                self.dof_vel * self.obs_scales["dof_vel"],  # 12
-                self.actions,  # 12
-                self.robot.get_pos(),  # 3
-                self.ball.get_pos(),  # 3
-                self.target.get_pos(),  # 3
-            ],
-            axis=-1,
-        )
+    def _update_state(self):
+        self.state.update(self.robot, self.ball, self.motor_dofs)
+        self.base_euler[:] = quat_to_xyz(transform_quat_by_quat(self.inv_base_init_quats, self.base_quat))
+        inv_base_quat = inv_quat(self.base_quat)
+        self.base_lin_vel[:] = transform_by_quat(self.state.base_vel, inv_base_quat)
+        self.base_ang_vel[:] = transform_by_quat(self.state.base_ang, inv_base_quat)
+        self.projected_gravity[:] = transform_by_quat(self.global_gravity, inv_base_quat)
+        if self.track_foot_contacts:
+            self._update_foot_contacts()
+
+    def _check_termination(self):
+        torch.gt(self.episode_length_buf, self.max_episode_length, out=self.reset_buf)
+        self.time_out_buf.copy_(self.reset_buf)
+        torch.abs(self.base_euler[:, :2], out=self.tilt_buf)
+        torch.gt(self.tilt_buf[:, 1], self.env_cfg["termination_if_pitch_greater_than"], out=self.termination_buf)
+        self.reset_buf |= self.termination_buf
+        torch.gt(self.tilt_buf[:, 0], self.env_cfg["termination_if_roll_greater_than"], out=self.termination_buf)
+        self.reset_buf |= self.termination_buf
+        torch.lt(self.base_pos[:, 2], self.env_cfg.get("termination_base_height", 0.4), out=self.termination_buf)
+        self.reset_buf |= self.termination_buf
 
-        self.last_actions[:] = self.actions[:]
-        self.last_dof_vel[:] = self.dof_vel[:]
+        # self.reset_buf |= self.is_ball_hit_target()
 
-        return self.obs_buf, None, self.rew_buf, self.reset_buf, self.extras
+    def _defer_resets(self):
+        # terminated envs are masked until the next flush: they keep reporting done with zero reward,
+        # so their extra steps neither bootstrap nor add to episode sums, and are reset together.
+        # Their samples are in extras["masked_envs"], the rollout storage gives them zero weight in the update
+        self.masked_envs.copy_(self.pending_resets)
+        self.pending_resets |= self.reset_buf
+        self.reset_buf |= self.pending_resets
+        self.time_out_buf.masked_fill_(self.masked_envs, 0.0)
+
+        self.steps_since_flush += 1
+        flush = self.steps_since_flush >= self.reset_flush_interval
+        if not flush and self.reset_flush_fraction < 1.0:
+            flush = self.pending_resets.sum() >= self.reset_flush_fraction * self.num_envs
+        if flush:
+            self.reset_idx(self.pending_resets.nonzero(as_tuple=False).flatten())
+            self.pending_resets.zero_()
+            self.steps_since_flush = 0
+
+    def _compute_reward(self):
+        self.reward_engine.compute(self.rew_buf, self.masked_envs if self.reset_flush_interval > 1 else None)
+
+    def _compute_observations(self):
+        # each slice is a preassigned view into obs_buf
+        torch.mul(self.base_ang_vel, self.obs_scales["ang_vel"], out=self.obs_views["ang_vel"])
+        self.obs_views["projected_gravity"].copy_(self.projected_gravity)
+        torch.mul(self.commands, self.commands_scale, out=self.obs_views["commands"])
+        torch.sub(self.dof_pos, self.default_dof_pos, out=self.obs_views["dof_pos"]).mul_(self.obs_scales["dof_pos"])
+        torch.mul(self.dof_vel, self.obs_scales["dof_vel"], out=self.obs_views["dof_vel"])
+        self.obs_views["actions"].copy_(self.actions)
+        self.obs_views["base_pos"].copy_(self.base_pos)
+        self.obs_views["ball_pos"].copy_(self.state.ball_pos)
+        self.obs_views["target_pos"].copy_(self.target_pos)
 
     def get_observations(self):
         return self.obs_buf
@@ -256,6 +403,28 @@ class KickerEnv:
         if len(envs_idx) == 0:
             return
 
+        if self.reset_pool is not None:
+            self.set_physics_state(self.reset_pool.sample(len(envs_idx), self.rng), envs_idx)
+        else:
+            self._reset_to_default(envs_idx)
+        # the pool states carry no target, both paths draw a new one
+        if self.randomize_target:
+            self._reset_targets(envs_idx)
+
+        # reset buffers
+        self.last_actions[envs_idx] = 0.0
+        self.last_dof_vel[envs_idx] = 0.0
+        self.episode_length_buf[envs_idx] = 0
+        self.reset_buf[envs_idx] = True
+
+        # fill extras
+        self.extras["episode"] = {}
+        for key, value in self.reward_engine.pop_episode_sums(envs_idx).items():
+            self.extras["episode"]["rew_" + key] = value / self.env_cfg["episode_length_s"]
+
+        self._resample_commands(envs_idx)
+
+    def _reset_to_default(self, envs_idx):
         # reset dofs
         self.dof_pos[envs_idx] = self.default_dof_pos
         self.dof_vel[envs_idx] = 0.0
@@ -273,35 +442,198 @@ class KickerEnv:
         self.robot.set_quat(self.base_quat[envs_idx], zero_velocity=False, envs_idx=envs_idx)
         self.base_lin_vel[envs_idx] = 0
         self.base_ang_vel[envs_idx] = 0
+        self.state.base_vel[envs_idx] = 0.0
+        self.state.base_ang[envs_idx] = 0.0
         self.robot.zero_all_dofs_velocity(envs_idx)
 
         # Randomly reset ball position
-        self.random_reset()
-
-        # reset buffers
-        self.last_actions[envs_idx] = 0.0
-        self.last_dof_vel[envs_idx] = 0.0
-        self.episode_length_buf[envs_idx] = 0
-        self.reset_buf[envs_idx] = True
-
-        # fill extras
-        self.extras["episode"] = {}
-        for key in self.episode_sums.keys():
-            self.extras["episode"]["rew_" + key] = (
-                torch.mean(self.episode_sums[key][envs_idx]).item() / self.env_cfg["episode_length_s"]
-            )
-            self.episode_sums[key][envs_idx] = 0.0
-
-        self._resample_commands(envs_idx)
+        self.random_reset(envs_idx)
+
+    def random_reset(self, envs_idx):
+        # some randomness, sampled on device only for the envs being reset
+        ball_pos = gs_rand_float(self.ball_pos_lower, self.ball_pos_upper, (len(envs_idx), 3), self.device, self.rng)
+        self.ball.set_pos(ball_pos, envs_idx=envs_idx)
+        self.state.ball_pos[envs_idx] = ball_pos
+        self.state.ball_vel[envs_idx] = 0.0
+
+    def _reset_targets(self, envs_idx):
+        n = len(envs_idx)
+        self.target_pos[envs_idx] = gs_rand_float(
+            self.target_pos_lower, self.target_pos_upper, (n, 3), self.device, self.rng)
+        self.target_half_size[envs_idx] = 0.5 * gs_rand_float(
+            self.target_size_lower, self.target_size_upper, (n, 3), self.device, self.rng)
+        if self.target is not None:
+            self.target.set_pos(self.target_pos[envs_idx], envs_idx=envs_idx)
+
+    def get_physics_state(self, envs_idx):
+        return {
+            "robot_qpos": self.robot.get_qpos(envs_idx=envs_idx),
+            "robot_dofs_vel": self.robot.get_dofs_velocity(envs_idx=envs_idx),
+            "ball_qpos": self.ball.get_qpos(envs_idx=envs_idx),
+            "ball_dofs_vel": self.ball.get_dofs_velocity(envs_idx=envs_idx),
+            # link velocities are kept as read back, the free joint velocity is not in the same frame
+            "base_vel": self.state.base_vel[envs_idx],
+            "base_ang": self.state.base_ang[envs_idx],
+        }
+
+    def set_physics_state(self, state, envs_idx):
+        # one batched write per entity and field, then the snapshot is patched for the restored envs
+        self.robot.set_qpos(state["robot_qpos"], zero_velocity=False, envs_idx=envs_idx)
+        self.robot.set_dofs_velocity(state["robot_dofs_vel"], envs_idx=envs_idx)
+        self.ball.set_qpos(state["ball_qpos"], zero_velocity=False, envs_idx=envs_idx)
+        self.ball.set_dofs_velocity(state["ball_dofs_vel"], envs_idx=envs_idx)
+
+        base_quat = state["robot_qpos"][:, 3:7]
+        self.base_pos[envs_idx] = state["robot_qpos"][:, :3]
+        self.base_quat[envs_idx] = base_quat
+        self.dof_pos[envs_idx] = state["robot_qpos"][:, self.motor_qs]
+        self.dof_vel[envs_idx] = state["robot_dofs_vel"][:, self.motor_dofs]
+        self.state.base_vel[envs_idx] = state["base_vel"]
+        self.state.base_ang[envs_idx] = state["base_ang"]
+        inv_base_quat = inv_quat(base_quat)
+        self.base_lin_vel[envs_idx] = transform_by_quat(state["base_vel"], inv_base_quat)
+        self.base_ang_vel[envs_idx] = transform_by_quat(state["base_ang"], inv_base_quat)
+        self.state.ball_pos[envs_idx] = state["ball_qpos"][:, :3]
+        self.state.ball_vel[envs_idx] = state["ball_dofs_vel"][:, :3]
+
+    # buffers carried from one step to the next, the rest is recomputed by every step
+    state_buffers = (
+        "obs_buf", "rew_buf", "reset_buf", "time_out_buf", "pending_resets", "masked_envs", "episode_length_buf",
+        "commands", "actions", "last_actions", "last_dof_vel", "target_pos", "target_half_size", "base_euler",
+        "base_lin_vel", "base_ang_vel", "projected_gravity", "foot_contacts",
+    )
+
+    def _solver_warm_start(self):
+        # what the rigid solver carries from one step to the next besides positions and velocities: the
+        # constraint solver warm start and the broad-phase sort order (the contact cache only serves non-convex
+        # geoms, the collision geoms here are convex). These are solver internals of Genesis 0.2.1; None when
+        # this Genesis version does not have them
+        solver = self.scene.sim.rigid_solver
+        fields = {}
+        for name, path in (("qacc_ws", "constraint_solver.qacc_ws"), ("first_time", "collider.first_time"),
+                           ("sort_buffer", "collider.sort_buffer"), ("geoms_state", "geoms_state")):
+            field = solver
+            for attr in path.split("."):
+                field = getattr(field, attr, None)
+            if not (hasattr(field, "to_torch") and hasattr(field, "from_torch")):
+                gs.logger.warning(f"The rigid solver has no field {path}, the env state does not include the solver "
+                                  "warm start and a resume is not bit-exact.")
+                return None
+            fields[name] = field
+        return fields
+
+    def get_state(self):
+        """Everything needed to continue this env exactly: the physics state and buffers of all envs, the step
+        counters, the random generator, the running episode sums and the reset pool. Without the solver warm
+        start (see _solver_warm_start) state["exact"] is False."""
+        all_envs = torch.arange(self.num_envs, device=self.device)
+        warm_start = self._solver_warm_start()
+        state = {name: getattr(self, name) for name in self.state_buffers}
+        state.update(
+            physics=self.get_physics_state(all_envs),
+            warm_start={name: field.to_torch() for name, field in warm_start.items()} if warm_start else None,
+            exact=warm_start is not None,
+            sim_state=vars(self.state),
+            rng=self.rng.get_state(),
+            steps_since_flush=self.steps_since_flush,
+            steps_since_refresh=self.steps_since_refresh,
+            reward_terms=self.reward_engine.names,
+            episode_sums=self.reward_engine.episode_sums,
+            episode_infos=self.extras.get("episode"),
+        )
+        if self.reset_pool is not None:
+            state["reset_pool"] = {
+                "buffers": self.reset_pool.buffers, "cursor": self.reset_pool.cursor, "count": self.reset_pool.count,
+            }
+        return state
+
+    def set_state(self, state):
+        """Restores a get_state() of an env with the same number of envs."""
+        all_envs = torch.arange(self.num_envs, device=self.device)
+        physics = {key: value.to(self.device) for key, value in state["physics"].items()}
+        self.set_physics_state(physics, all_envs)
+        warm_start = self._solver_warm_start()
+        if warm_start is not None and state.get("warm_start") is not None:
+            for name, field in warm_start.items():
+                field.from_torch(state["warm_start"][name])
+        elif warm_start is not None:
+            gs.logger.warning("The env state has no solver warm start, the resume is not bit-exact.")
+        for name, value in state["sim_state"].items():
+            getattr(self.state, name).copy_(value)
+        for name in self.state_buffers:
+            getattr(self, name).copy_(state[name])
+        if self.target is not None:
+            self.target.set_pos(self.target_pos)
+        self.rng.set_state(state["rng"])
+        self.steps_since_flush = state["steps_since_flush"]
+        self.steps_since_refresh = state["steps_since_refresh"]
+        # a new curriculum stage has other reward terms, its episode sums start from zero
+        if state["reward_terms"] == self.reward_engine.names:
+            self.reward_engine.episode_sums.copy_(state["episode_sums"])
+            if state["episode_infos"] is not None:
+                self.extras["episode"] = {key: value.to(self.device) for key, value in state["episode_infos"].items()}
+        if self.reset_pool is not None and "reset_pool" in state:
+            self.reset_pool.buffers = {key: value.to(self.device) for key, value in state["reset_pool"]["buffers"].items()}
+            self.reset_pool.cursor = state["reset_pool"]["cursor"]
+            self.reset_pool.count = state["reset_pool"]["count"]
+
+    def _fill_reset_pool(self, size):
+        # drop the robots from the default pose with some joint noise, hold the default PD target until the
+        # landing transient is over and keep the envs that are upright and slow
+        self.reset_pool = ResetStatePool(size, self.device)
+        all_envs = torch.arange(self.num_envs, device=self.device)
+        noise = self.env_cfg.get("reset_pool_joint_noise", 0.05)
+        for _ in range(math.ceil(size / self.num_envs)):
+            self._reset_to_default(all_envs)
+            self.dof_pos.add_(noise * torch.randn(self.dof_pos.shape, device=self.device, generator=self.rng))
+            self.robot.set_dofs_position(self.dof_pos, self.motor_dofs, zero_velocity=True)
+            self.robot.control_dofs_position(self.default_dof_pos.repeat(self.num_envs, 1), self.motor_dofs)
+            for _ in range(self.env_cfg.get("reset_pool_settle_steps", 10)):
+                self.scene.step()
+            self.episode_length_buf.zero_()
+            self._update_state()
+            self._check_termination()
+            self.reset_pool.add(self.get_physics_state(all_envs[self._settled_envs(~self.reset_buf)]))
+
+        if len(self.reset_pool) == 0:
+            gs.logger.warning("No robot settled upright, resetting from the default pose instead.")
+            self.reset_pool = None
+        self.reset()
+
+    def _settled_envs(self, mask):
+        # expects tilt_buf from _check_termination of the same step
+        mask = mask & (torch.norm(self.state.base_vel, dim=-1) < self.env_cfg.get("reset_pool_max_base_vel", 0.5))
+        return mask & (self.tilt_buf.amax(dim=1) < self.env_cfg.get("reset_pool_max_tilt", 10))
+
+    def _refresh_reset_pool(self):
+        # capture envs that have survived a while, moved back over base_init_pos and turned back to the heading of
+        # base_init_quat (keeping the settled roll and pitch), with a fresh ball at rest
+        healthy = self.episode_length_buf >= self.env_cfg.get("reset_pool_refresh_min_steps", 50)
+        healthy &= ~(self.reset_buf | self.pending_resets)
+        envs_idx = self._settled_envs(healthy).nonzero(as_tuple=False).flatten()
+        count = self.env_cfg.get("reset_pool_refresh_count", max(1, self.num_envs // 16))
+        if len(envs_idx) > count:
+            envs_idx = envs_idx[torch.randperm(len(envs_idx), device=self.device, generator=self.rng)[:count]]
+        if len(envs_idx) == 0:
+            return
 
-    def random_reset(self):
-        random_positions = []
-        for _ in range(self.num_envs):
-            # some randomness
-            pos = [random.uniform(0.1, 0.11), random.uniform(-0.15, -0.16), self.ball_radius]
-            random_positions.append(pos)
-        ball_positions = torch.tensor(random_positions, device=self.device).cpu().numpy()
-        self.ball.set_pos(ball_positions, envs_idx=torch.arange(self.num_envs))
+        state = self.get_physics_state(envs_idx)
+        state["robot_qpos"][:, :2] = self.base_init_pos[:2]
+        base_quat = state["robot_qpos"][:, 3:7]
+        heading = quat_to_xyz(transform_quat_by_quat(self.inv_base_init_quats[envs_idx], base_quat))[:, 2]
+        zeros = torch.zeros_like(heading)
+        unturn = xyz_to_quat(torch.stack([zeros, zeros, -heading], dim=-1))
+        state["robot_qpos"][:, 3:7] = transform_quat_by_quat(base_quat, unturn)
+        state["ball_qpos"][:, :3] = gs_rand_float(
+            self.ball_pos_lower, self.ball_pos_upper, (len(envs_idx), 3), self.device, self.rng)
+        state["ball_qpos"][:, 3:] = torch.tensor([1.0, 0.0, 0.0, 0.0], device=self.device)
+        state["ball_dofs_vel"].zero_()
+        self.reset_pool.add(state)
+
+    def _update_foot_contacts(self):
+        # a foot is in contact when the net external contact force on its link is non-negligible
+        contact_force = self.robot.get_links_net_contact_force()[:, self.feet_links_idx]
+        self.foot_contacts[:] = torch.norm(contact_force, dim=-1) > self.env_cfg.get("foot_contact_threshold", 1.0)
 
     def reset(self):
         self.reset_buf[:] = True
@@ -309,19 +641,9 @@ class KickerEnv:
         return self.obs_buf, None
 
     def is_ball_hit_target(self):
-        ball_pos = self.ball.get_pos()
-        target_pos = self.target.get_pos()
-
-        hit_x = (ball_pos[:, 0] - self.ball_radius <= target_pos[:, 0] + self.target_size[0] / 2) & \
-                (ball_pos[:, 0] + self.ball_radius >= target_pos[:, 0] - self.target_size[0] / 2)
-
-        hit_y = (ball_pos[:, 1] - self.ball_radius <= target_pos[:, 1] + self.target_size[1] / 2) & \
-                (ball_pos[:, 1] + self.ball_radius >= target_pos[:, 1] - self.target_size[1] / 2)
-
-        hit_z = (ball_pos[:, 2] - self.ball_radius <= target_pos[:, 2] + self.target_size[2] / 2) & \
-                (ball_pos[:, 2] + self.ball_radius >= target_pos[:, 2] - self.target_size[2] / 2)
-
-        return hit_x & hit_y & hit_z
+        # the ball touches the target box when it is within radius of the box faces on every axis
+        torch.sub(self.state.ball_pos, self.target_pos, out=self.ball_hit_dist).abs_().sub_(self.target_half_size)
+        return torch.all(self.ball_hit_dist <= self.ball_radius, dim=1)
 
     # ------------ reward functions----------------
     def _reward_forward_velocity(self):
@@ -332,18 +654,16 @@ class KickerEnv:
     def _reward_ball_hit_target(self):
         hit = self.is_ball_hit_target()
         # the faster the ball hits the target, the higher the reward
-        ball_velocity = torch.norm(self.ball.get_vel(), dim=-1)
+        ball_velocity = torch.norm(self.state.ball_vel, dim=-1)
         return torch.where(hit, ball_velocity, torch.zeros((self.num_envs,), device=self.device))
 
     def _reward_ball_distance_from_target(self):
-        ball_pos = self.ball.get_pos()
-        target_pos = self.target.get_pos()
-        ball_distance = torch.norm(ball_pos - target_pos, dim=-1)
+        ball_distance = torch.norm(self.state.ball_pos - self.target_pos, dim=-1)
         # ball_distance = torch.nan_to_num(ball_distance, nan=10.0)
         return -ball_distance
 
     def _reward_episode_length(self):
-        return -1.0
+        return -torch.ones(self.num_envs, device=self.device)
 
     def _reward_base_height(self):
         return -self.base_pos[:, 2]
@@ -361,19 +681,7 @@ class KickerEnv:
 
     # penalize if both feet are in contact
     def _reward_foot_contact(self):
-        left_foot_link_name = "left_ankle_roll_link"
-        right_foot_link_name = "right_ankle_roll_link"
-
-        left_foot_entity = self.robot.get_link(left_foot_link_name)
-        right_foot_entity = self.robot.get_link(right_foot_link_name)
-
-        left_foot_contacts = self.robot.get_contacts(with_entity=left_foot_entity)
-        right_foot_contacts = self.robot.get_contacts(with_entity=right_foot_entity)
-
-        left_foot_in_contact = torch.tensor(left_foot_contacts["valid_mask"], device=self.device).any(dim=1).float()
-        right_foot_in_contact = torch.tensor(right_foot_contacts["valid_mask"], device=self.device).any(dim=1).float()
-
-        return -(left_foot_in_contact * right_foot_in_contact)
+        return -torch.all(self.foot_contacts, dim=1).float()
 
     def _reward_leg_swing(self):
         # Get the hip and knee joint actions for both legs.
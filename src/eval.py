@@ -46,5 +46,5 @@ if __name__ == "__main__":
 
 """
 # evaluation
-python src/eval.py -e kicker -v --ckpt 0
+python src/eval.py -e kicker -v --ckpt 50
 """
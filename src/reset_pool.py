@@ -0,0 +1,42 @@
+import torch
+
+
+class ResetStatePool:
+    """Ring buffer of physics states that reset_idx restores instead of dropping the robot from base_init_pos.
+
+    A state is a dict of per-env tensors (see KickerEnv.get_physics_state). The pool is filled with settled
+    states before training and refreshed from live rollouts, overwriting the oldest entries first.
+    """
+
+    def __init__(self, size, device):
+        self.size = size
+        self.device = device
+        self.buffers = None
+        self.cursor = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, state):
+        n = len(next(iter(state.values())))
+        if n == 0:
+            return
+        if n > self.size:
+            state = {key: value[-self.size:] for key, value in state.items()}
+            n = self.size
+        if self.buffers is None:
+            self.buffers = {
+                key: torch.zeros((self.size,) + value.shape[1:], device=self.device, dtype=value.dtype)
+                for key, value in state.items()
+            }
+
+        slots = torch.arange(self.cursor, self.cursor + n, device=self.device) % self.size
+        for key, value in state.items():
+            self.buffers[key][slots] = value
+        self.cursor = (self.cursor + n) % self.size
+        self.count = min(self.count + n, self.size)
+
+    def sample(self, n, generator=None):
+        idx = torch.randint(self.count, (n,), device=self.device, generator=generator)
+        return {key: buffer[idx] for key, buffer in self.buffers.items()}
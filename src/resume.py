@@ -2,6 +2,8 @@ import argparse
 import os
 import pickle
 
+import torch
+
 from env import KickerEnv
 from curriculum import get_reward_scales
 from rsl_rl.runners import OnPolicyRunner
@@ -9,66 +11,33 @@ from rsl_rl.runners import OnPolicyRunner
 import genesis as gs
 
 
-def get_train_cfg(exp_name, max_iterations, resume_path=None):
-    train_cfg_dict = {
-        "algorithm": {
-            "clip_param": 0.2,
-            "desired_kl": 0.01,
-            "entropy_coef": 0.01,
-            "gamma": 0.99,
-            "lam": 0.95,
-            "learning_rate": 0.001,
-            "max_grad_norm": 1.0,
-            "num_learning_epochs": 5,
-            "num_mini_batches": 4,
-            "schedule": "adaptive",
-            "use_clipped_value_loss": True,
-            "value_loss_coef": 1.0,
-        },
-        "policy": {
-            "activation": "elu",
-            "actor_hidden_dims": [512, 256, 128],
-            "critic_hidden_dims": [512, 256, 128],
-            "init_noise_std": 1.0,
-        },
-        "runner": {
-            "algorithm_class_name": "PPO",
-            "checkpoint": -1,
-            "experiment_name": exp_name,
-            "load_run": -1,
-            "log_interval": 1,
-            "max_iterations": max_iterations,
-            "num_steps_per_env": 64,
-            "policy_class_name": "ActorCritic",
-            "record_interval": -1,
-            "resume": True,
-            "resume_path": resume_path,
-            "run_name": "",
-            "save_interval": 50,
-        },
-        "runner_class_name": "OnPolicyRunner",
-        "seed": 1,
-    }
-    return train_cfg_dict
-
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-e", "--exp_name", type=str, default="kicker")
     parser.add_argument("-n", "--new_exp_name", type=str, default="kicker")
     parser.add_argument("--resume_ckpt", type=int, default=100, help="Checkpoint to resume from")
     parser.add_argument("--max_iterations", type=int, default=1000, help="Number of additional training iterations")
+    parser.add_argument("-B", "--num_envs", type=int, default=2048,
+                        help="Number of envs for checkpoints without training state")
+    parser.add_argument("-d", "--device", type=str, default="mps", help="Device of the policy and the training")
     args = parser.parse_args()
 
-    gs.init(logging_level="warning")
+    gs.init(backend=gs.cpu if args.device == "cpu" else gs.gpu, logging_level="warning")
 
     current_dir = os.path.dirname(__file__)
     log_dir = os.path.join(current_dir, f"../logs/{args.exp_name}")
     resume_path = os.path.join(log_dir, f"model_{args.resume_ckpt}.pt")
 
+    # the run continues with its own train cfg and number of envs, only the reward scales change
     env_cfg, obs_cfg, reward_cfg, command_cfg, train_cfg = pickle.load(open(f"{log_dir}/cfgs.pkl", "rb"))
-    train_cfg = get_train_cfg(args.exp_name, args.max_iterations, resume_path)
+    train_cfg["runner"].update(
+        experiment_name=args.new_exp_name, max_iterations=args.max_iterations, resume=True, resume_path=resume_path)
     reward_cfg["reward_scales"] = get_reward_scales(args.new_exp_name)
+    checkpoint = torch.load(resume_path, weights_only=False)
+    training_state = checkpoint.get("training_state")
+    num_envs = training_state["num_envs"] if training_state is not None else args.num_envs
+    if training_state is not None and training_state["curriculum_stage"] != args.new_exp_name:
+        print(f"Curriculum stage {training_state['curriculum_stage']} -> {args.new_exp_name}")
 
     updated_log_dir = os.path.join(current_dir, f"../logs/{args.new_exp_name}")
     os.makedirs(updated_log_dir, exist_ok=True)
@@ -78,18 +47,20 @@ def main():
     )
 
     env = KickerEnv(
-        num_envs=train_cfg["runner"]["num_steps_per_env"],
+        num_envs=num_envs,
         env_cfg=env_cfg,
         obs_cfg=obs_cfg,
         reward_cfg=reward_cfg,
         command_cfg=command_cfg,
+        device=args.device,
     )
 
-    runner = OnPolicyRunner(env, train_cfg, updated_log_dir, device="mps")
-    runner.load(resume_path)
+    runner = OnPolicyRunner(env, train_cfg, updated_log_dir, device=args.device)
+    runner.load(checkpoint, load_training_state=True)
 
-    # Train
-    runner.learn(num_learning_iterations=args.max_iterations, init_at_random_ep_len=True)
+    # Train, a checkpoint with the env state continues its episodes where they were instead of re-randomizing them
+    has_env_state = training_state is not None and "env" in training_state
+    runner.learn(num_learning_iterations=args.max_iterations, init_at_random_ep_len=not has_env_state)
 
 
 if __name__ == "__main__":
@@ -34,6 +34,7 @@ import torch.optim as optim
 
 from rsl_rl.modules import ActorCritic
 from rsl_rl.storage import RolloutStorage
+from rsl_rl.utils import phase
 
 class PPO:
     actor_critic: ActorCritic
@@ -52,6 +53,12 @@ class PPO:
                  schedule="fixed",
                  desired_kl=0.01,
                  device='cpu',
+                 write_through=False,
+                 sync_free_update=False,
+                 compile_update=False,
+                 compile_gae=False,
+                 mixed_precision=None,
+                 storage_dtype=None,
                  ):
 
         self.device = device
@@ -64,7 +71,43 @@ class PPO:
         self.actor_critic = actor_critic
         self.actor_critic.to(self.device)
         self.storage = None # initialized later
-        self.optimizer = optim.Adam(self.actor_critic.parameters(), lr=learning_rate)
+        # "bf16" or "fp16" keeps the observations and mu of the rollout storage in that dtype
+        self.storage_dtype = {None: None, "bf16": torch.bfloat16, "fp16": torch.float16}[storage_dtype]
+        # sync-free update: the adaptive learning rate is a device tensor shared with the optimizer param group
+        # (only the fused Adam reads a tensor lr without a host sync), losses are summed on device
+        self.sync_free_update = sync_free_update
+        # compiled update: minibatch loss and optimizer step are compiled once for the static minibatch shape,
+        # the lr is a tensor so that the adaptive schedule does not trigger recompiles
+        self.compile_update = compile_update and not actor_critic.is_recurrent
+        self.learning_rate_tensor = None
+        if sync_free_update or self.compile_update:
+            if fused_adam_supports_tensor_lr(self.device):
+                self.learning_rate_tensor = torch.tensor(learning_rate, device=self.device)
+                self.optimizer = optim.Adam(self.actor_critic.parameters(), lr=self.learning_rate_tensor, fused=True)
+                self.optimizer.register_load_state_dict_post_hook(self._share_learning_rate)
+            else:
+                # the adaptive schedule then runs on the host, syncing once per minibatch
+                print(f"Fused Adam with a tensor learning rate is not supported on {self.device}, "
+                      "using the foreach Adam with a float learning rate")
+                self.optimizer = optim.Adam(self.actor_critic.parameters(), lr=learning_rate, foreach=True)
+        else:
+            self.optimizer = optim.Adam(self.actor_critic.parameters(), lr=learning_rate)
+        # actor and critic MLPs under autocast ("bf16" or "fp16") in collection and update; their outputs, the losses,
+        # GAE and the optimizer state stay fp32. fp16 gradients go through a GradScaler
+        if mixed_precision not in (None, "bf16", "fp16"):
+            raise ValueError(f"mixed_precision must be None, 'bf16' or 'fp16', got {mixed_precision}")
+        self.mixed_precision = mixed_precision
+        device_type = torch.device(self.device).type
+        self.autocast = torch.autocast(device_type, dtype=torch.float16 if mixed_precision == "fp16" else torch.bfloat16,
+                                       enabled=mixed_precision is not None)
+        self.grad_scaler = torch.amp.GradScaler(device_type) if mixed_precision == "fp16" else None
+        self._minibatch_loss = self.minibatch_loss
+        self._optimizer_step = self.optimizer_step
+        if self.compile_update:
+            self._minibatch_loss = torch.compile(self.minibatch_loss, dynamic=False)
+            # with a float lr every change of the adaptive lr would recompile the step
+            if self.learning_rate_tensor is not None:
+                self._optimizer_step = torch.compile(self.optimizer_step, dynamic=False)
         self.transition = RolloutStorage.Transition()
 
         # PPO parameters
@@ -77,9 +120,15 @@ class PPO:
         self.lam = lam
         self.max_grad_norm = max_grad_norm
         self.use_clipped_value_loss = use_clipped_value_loss
+        # write the policy outputs straight into the storage slots of the current step instead of a Transition
+        self.write_through = write_through
+        # GAE as one compiled kernel instead of the step loop
+        self.compile_gae = compile_gae
 
-    def init_storage(self, num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, action_shape):
-        self.storage = RolloutStorage(num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, action_shape, self.device)
+    def init_storage(self, num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, action_shape, sample_mask=False):
+        self.storage = RolloutStorage(num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, action_shape, self.device,
+                                      compressed_dtype=self.storage_dtype, sample_mask=sample_mask,
+                                      compile_gae=self.compile_gae)
 
     def test_mode(self):
         self.actor_critic.test()
@@ -88,22 +137,40 @@ class PPO:
         self.actor_critic.train()
 
     def act(self, obs, critic_obs):
+        with self.autocast:
+            return self._act(obs, critic_obs)
+
+    def _act(self, obs, critic_obs):
         if self.actor_critic.is_recurrent:
             self.transition.hidden_states = self.actor_critic.get_hidden_states()
+        if self.write_through:
+            self.storage.add_observations(obs, critic_obs)
+            slots = self.storage.policy_slots()
+            self.actor_critic.act_into(obs, critic_obs, *slots)
+            return slots[0]
         # Compute the actions and values
         self.transition.actions = self.actor_critic.act(obs).detach()
         self.transition.values = self.actor_critic.evaluate(critic_obs).detach()
         self.transition.actions_log_prob = self.actor_critic.get_actions_log_prob(self.transition.actions).detach()
         self.transition.action_mean = self.actor_critic.action_mean.detach()
         self.transition.action_sigma = self.actor_critic.action_std.detach()
-        # need to record obs and critic_obs before env.step()
-        self.transition.observations = obs
-        self.transition.critic_observations = critic_obs
+        # need to record obs and critic_obs before env.step(), which overwrites its buffers in place
+        self.storage.add_observations(obs, critic_obs)
         return self.transition.actions
     
     def process_env_step(self, rewards, dones, infos):
+        if self.write_through:
+            step = self.storage.step
+            self.storage.add_rewards_and_dones(rewards, dones, self.transition.hidden_states, infos.get('masked_envs'))
+            # Bootstrapping on time outs
+            if 'time_outs' in infos:
+                self.storage.rewards[step] += self.gamma * (self.storage.values[step] * infos['time_outs'].unsqueeze(1).to(self.device))
+            self.transition.hidden_states = None
+            self.actor_critic.reset(dones)
+            return
         self.transition.rewards = rewards.clone()
         self.transition.dones = dones
+        self.transition.masked = infos.get('masked_envs')
         # Bootstrapping on time outs
         if 'time_outs' in infos:
             self.transition.rewards += self.gamma * torch.squeeze(self.transition.values * infos['time_outs'].unsqueeze(1).to(self.device), 1)
@@ -114,74 +181,157 @@ class PPO:
         self.actor_critic.reset(dones)
     
     def compute_returns(self, last_critic_obs):
-        last_values= self.actor_critic.evaluate(last_critic_obs).detach()
+        with self.autocast:
+            last_values= self.actor_critic.evaluate(last_critic_obs).detach()
         self.storage.compute_returns(last_values, self.gamma, self.lam)
 
     def update(self):
-        mean_value_loss = 0
-        mean_surrogate_loss = 0
+        if self.sync_free_update:
+            mean_value_loss = torch.zeros((), device=self.device)
+            mean_surrogate_loss = torch.zeros((), device=self.device)
+        else:
+            mean_value_loss = 0
+            mean_surrogate_loss = 0
         if self.actor_critic.is_recurrent:
             generator = self.storage.reccurent_mini_batch_generator(self.num_mini_batches, self.num_learning_epochs)
         else:
             generator = self.storage.mini_batch_generator(self.num_mini_batches, self.num_learning_epochs)
         for obs_batch, critic_obs_batch, actions_batch, target_values_batch, advantages_batch, returns_batch, old_actions_log_prob_batch, \
-            old_mu_batch, old_sigma_batch, hid_states_batch, masks_batch in generator:
+            old_mu_batch, old_sigma_batch, hid_states_batch, masks_batch, weights_batch in generator:
 
 
-                self.actor_critic.act(obs_batch, masks=masks_batch, hidden_states=hid_states_batch[0])
-                actions_log_prob_batch = self.actor_critic.get_actions_log_prob(actions_batch)
-                value_batch = self.actor_critic.evaluate(critic_obs_batch, masks=masks_batch, hidden_states=hid_states_batch[1])
-                mu_batch = self.actor_critic.action_mean
-                sigma_batch = self.actor_critic.action_std
-                entropy_batch = self.actor_critic.entropy
+                with self.autocast, phase('update.forward'):
+                    loss, value_loss, surrogate_loss, kl_mean = self._minibatch_loss(
+                        obs_batch, critic_obs_batch, actions_batch, target_values_batch, advantages_batch, returns_batch,
+                        old_actions_log_prob_batch, old_mu_batch, old_sigma_batch, masks_batch, hid_states_batch,
+                        weights_batch)
 
                 # KL
                 if self.desired_kl != None and self.schedule == 'adaptive':
                     with torch.inference_mode():
-                        kl = torch.sum(
-                            torch.log(sigma_batch / old_sigma_batch + 1.e-5) + (torch.square(old_sigma_batch) + torch.square(old_mu_batch - mu_batch)) / (2.0 * torch.square(sigma_batch)) - 0.5, axis=-1)
-                        kl_mean = torch.mean(kl)
-
-                        if kl_mean > self.desired_kl * 2.0:
-                            self.learning_rate = max(1e-5, self.learning_rate / 1.5)
-                        elif kl_mean < self.desired_kl / 2.0 and kl_mean > 0.0:
-                            self.learning_rate = min(1e-2, self.learning_rate * 1.5)
-                        
-                        for param_group in self.optimizer.param_groups:
-                            param_group['lr'] = self.learning_rate
-
-
-                # Surrogate loss
-                ratio = torch.exp(actions_log_prob_batch - torch.squeeze(old_actions_log_prob_batch) + 1e-8)
-                surrogate = -torch.squeeze(advantages_batch) * ratio
-                surrogate_clipped = -torch.squeeze(advantages_batch) * torch.clamp(ratio, 1.0 - self.clip_param,
-                                                                                1.0 + self.clip_param)
-                surrogate_loss = torch.max(surrogate, surrogate_clipped).mean()
-
-                # Value function loss
-                if self.use_clipped_value_loss:
-                    value_clipped = target_values_batch + (value_batch - target_values_batch).clamp(-self.clip_param,
-                                                                                                    self.clip_param)
-                    value_losses = (value_batch - returns_batch).pow(2)
-                    value_losses_clipped = (value_clipped - returns_batch).pow(2)
-                    value_loss = torch.max(value_losses, value_losses_clipped).mean()
-                else:
-                    value_loss = (returns_batch - value_batch).pow(2).mean()
-
-                loss = surrogate_loss + self.value_loss_coef * value_loss - self.entropy_coef * entropy_batch.mean()
+                        if self.learning_rate_tensor is not None:
+                            self._adapt_learning_rate(kl_mean)
+                        else:
+                            if kl_mean > self.desired_kl * 2.0:
+                                self.learning_rate = max(1e-5, self.learning_rate / 1.5)
+                            elif kl_mean < self.desired_kl / 2.0 and kl_mean > 0.0:
+                                self.learning_rate = min(1e-2, self.learning_rate * 1.5)
+                            self.set_learning_rate(self.learning_rate)
 
                 # Gradient step
                 self.optimizer.zero_grad()
-                loss.backward()
-                nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
-                self.optimizer.step()
+                with phase('update.backward'):
+                    if self.grad_scaler is not None:
+                        loss = self.grad_scaler.scale(loss)
+                    loss.backward()
+                with phase('update.optimizer_step'):
+                    self._optimizer_step()
 
-                mean_value_loss += value_loss.item()
-                mean_surrogate_loss += surrogate_loss.item()
+                if self.sync_free_update:
+                    mean_value_loss += value_loss
+                    mean_surrogate_loss += surrogate_loss
+                else:
+                    mean_value_loss += value_loss.item()
+                    mean_surrogate_loss += surrogate_loss.item()
 
+        if self.sync_free_update and self.learning_rate_tensor is not None:
+            # the only host sync of the update
+            mean_value_loss, mean_surrogate_loss, self.learning_rate = torch.stack(
+                [mean_value_loss, mean_surrogate_loss, self.learning_rate_tensor]).tolist()
+        elif self.sync_free_update:
+            mean_value_loss, mean_surrogate_loss = torch.stack([mean_value_loss, mean_surrogate_loss]).tolist()
         num_updates = self.num_learning_epochs * self.num_mini_batches
         mean_value_loss /= num_updates
         mean_surrogate_loss /= num_updates
         self.storage.clear()
 
         return mean_value_loss, mean_surrogate_loss
+
+    def minibatch_loss(self, obs_batch, critic_obs_batch, actions_batch, target_values_batch, advantages_batch, returns_batch,
+                       old_actions_log_prob_batch, old_mu_batch, old_sigma_batch, masks_batch=None, hid_states_batch=(None, None),
+                       weights_batch=None):
+        """ Forward pass and PPO losses of one minibatch.
+            Returns the total loss, the value and surrogate losses and the mean KL to the rollout policy (None unless adaptive).
+            With weights_batch, every mean is weighted by it, so that samples of weight 0 do not count.
+        """
+        sample_weights = torch.squeeze(weights_batch) if weights_batch is not None else None
+        self.actor_critic.act(obs_batch, masks=masks_batch, hidden_states=hid_states_batch[0])
+        actions_log_prob_batch = self.actor_critic.get_actions_log_prob(actions_batch)
+        value_batch = self.actor_critic.evaluate(critic_obs_batch, masks=masks_batch, hidden_states=hid_states_batch[1])
+        entropy_batch = self.actor_critic.entropy
+
+        kl_mean = None
+        if self.desired_kl != None and self.schedule == 'adaptive':
+            with torch.no_grad():
+                kl_mean = weighted_mean(self.actor_critic.kl(old_mu_batch, old_sigma_batch), sample_weights)
+
+        # Surrogate loss
+        ratio = torch.exp(actions_log_prob_batch - torch.squeeze(old_actions_log_prob_batch) + 1e-8)
+        surrogate = -torch.squeeze(advantages_batch) * ratio
+        surrogate_clipped = -torch.squeeze(advantages_batch) * torch.clamp(ratio, 1.0 - self.clip_param,
+                                                                        1.0 + self.clip_param)
+        surrogate_loss = weighted_mean(torch.max(surrogate, surrogate_clipped), sample_weights)
+
+        # Value function loss
+        if self.use_clipped_value_loss:
+            value_clipped = target_values_batch + (value_batch - target_values_batch).clamp(-self.clip_param,
+                                                                                            self.clip_param)
+            value_losses = (value_batch - returns_batch).pow(2)
+            value_losses_clipped = (value_clipped - returns_batch).pow(2)
+            value_loss = weighted_mean(torch.max(value_losses, value_losses_clipped), weights_batch)
+        else:
+            value_loss = weighted_mean((returns_batch - value_batch).pow(2), weights_batch)
+
+        loss = surrogate_loss + self.value_loss_coef * value_loss - self.entropy_coef * weighted_mean(entropy_batch, sample_weights)
+        return loss, value_loss.detach(), surrogate_loss.detach(), kl_mean
+
+    def optimizer_step(self):
+        if self.grad_scaler is not None:
+            # clip the unscaled gradients, the scaler skips the step on inf/nan
+            self.grad_scaler.unscale_(self.optimizer)
+            nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
+            return
+        nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
+        self.optimizer.step()
+
+    def set_learning_rate(self, learning_rate):
+        self.learning_rate = learning_rate
+        if self.learning_rate_tensor is not None:
+            self.learning_rate_tensor.fill_(learning_rate)
+        else:
+            for param_group in self.optimizer.param_groups:
+                param_group['lr'] = learning_rate
+
+    def _share_learning_rate(self, optimizer):
+        # load_state_dict replaces the param group lr with the checkpointed value, put the shared tensor back
+        self.learning_rate_tensor.fill_(float(optimizer.param_groups[0]['lr']))
+        self.learning_rate = self.learning_rate_tensor.item()
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = self.learning_rate_tensor
+
+    def _adapt_learning_rate(self, kl_mean):
+        # same schedule as the host branch in update, evaluated on device and written into the shared lr tensor
+        lr = self.learning_rate_tensor
+        decreased = torch.clamp(lr / 1.5, min=1e-5)
+        increased = torch.clamp(lr * 1.5, max=1e-2)
+        lr.copy_(torch.where(kl_mean > self.desired_kl * 2.0, decreased,
+                             torch.where((kl_mean < self.desired_kl / 2.0) & (kl_mean > 0.0), increased, lr)))
+
+
+def fused_adam_supports_tensor_lr(device):
+    """ Whether a fused Adam step with a tensor learning rate runs on device (not every backend has the kernel). """
+    param = torch.zeros(1, device=device, requires_grad=True)
+    param.grad = torch.zeros_like(param)
+    try:
+        optim.Adam([param], lr=torch.tensor(1e-3, device=device), fused=True).step()
+    except (RuntimeError, NotImplementedError, ValueError, TypeError):
+        return False
+    return True
+
+
+def weighted_mean(values, weights=None):
+    if weights is None:
+        return values.mean()
+    return (values * weights).sum() / weights.sum()
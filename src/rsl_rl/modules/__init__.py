@@ -29,4 +29,5 @@
 # Copyright (c) 2021 ETH Zurich, Nikita Rudin
 
 from .actor_critic import ActorCritic
-from .actor_critic_recurrent import ActorCriticRecurrent
\ No newline at end of file
+from .actor_critic_recurrent import ActorCriticRecurrent
+from .diag_gaussian import DiagGaussian
\ No newline at end of file
@@ -28,6 +28,8 @@
 #
 # Copyright (c) 2021 ETH Zurich, Nikita Rudin
 
+import math
+
 import numpy as np
 
 import torch
@@ -35,6 +37,8 @@ import torch.nn as nn
 from torch.distributions import Normal
 from torch.nn.modules import rnn
 
+from .diag_gaussian import DiagGaussian, kl_divergence
+
 
 class ActorCritic(nn.Module):
     is_recurrent = False
@@ -46,6 +50,8 @@ class ActorCritic(nn.Module):
                  critic_hidden_dims=[256, 256, 256],
                  activation='elu',
                  init_log_std=0.0,  # use log_std instead
+                 compile_rollout=False,
+                 diag_gaussian=False,
                  **kwargs):
         if kwargs:
             print("ActorCritic.__init__ got unexpected arguments, which will be ignored: " +
@@ -86,10 +92,20 @@ class ActorCritic(nn.Module):
 
         # Action noise
         self.std = nn.Parameter(torch.full((num_actions,), init_log_std))
-        self.distribution = None
+        # closed-form head updated in place, or a new torch.distributions.Normal per update
+        self.diag_gaussian = diag_gaussian
+        self.distribution = DiagGaussian() if diag_gaussian else None
         # disable args validation for speedup
         Normal.set_default_validate_args = False
 
+        # act_rollout is compiled on first use, the compiled function lives in _compiled_act_rollout (not on the module)
+        self.compile_rollout = compile_rollout
+        # the first layers of actor and critic can run as one matmul when both MLPs start with a Linear
+        self.fused_first_layer = all(isinstance(mlp[0], nn.Linear) for mlp in (self.actor, self.critic))
+        # concatenated first layers of actor and critic, rebuilt once the parameters changed (optimizer step, load)
+        self._fused_in = None
+        self._fused_in_key = None
+
         # seems that we get better performance without init
         # self.init_memory_weights(self.memory_a, 0.001, 0.)
         # self.init_memory_weights(self.memory_c, 0.001, 0.)
@@ -119,8 +135,12 @@ class ActorCritic(nn.Module):
         return self.distribution.entropy().sum(dim=-1)
 
     def update_distribution(self, observations):
-        mean = self.actor(observations)
+        # MLP outputs are fp32 under autocast too, the distribution and losses stay in full precision
+        mean = self.actor(observations).float()
         mean = torch.nan_to_num(mean, nan=0.0, posinf=1e3, neginf=-1e3)
+        if self.diag_gaussian:
+            self.distribution.update(mean, self.std.clamp(min=-20, max=2))
+            return
         log_std = torch.exp(self.std.clamp(min=-20, max=2))
         self.distribution = Normal(mean, log_std.expand_as(mean), validate_args=False)
 
@@ -131,15 +151,86 @@ class ActorCritic(nn.Module):
     def get_actions_log_prob(self, actions):
         return self.distribution.log_prob(actions).sum(dim=-1)
 
+    def kl(self, old_mean, old_std):
+        if self.diag_gaussian:
+            return self.distribution.kl(old_mean, old_std)
+        return kl_divergence(self.action_mean, self.action_std, old_mean, old_std)
+
+    def rollout_forward(self, observations, critic_observations):
+        # actor mean and critic value; when the critic sees the actor observations, both first layers run as one matmul
+        if critic_observations is observations and self.fused_first_layer:
+            actor_in, critic_in = self.actor[0], self.critic[0]
+            if self.compile_rollout:
+                # the compiled graph fuses the concatenation itself
+                weight, bias = torch.cat((actor_in.weight, critic_in.weight)), torch.cat((actor_in.bias, critic_in.bias))
+            else:
+                weight, bias = self._fused_first_layer(actor_in, critic_in)
+            hidden = nn.functional.linear(observations, weight, bias)
+            hidden_a, hidden_c = hidden.split([actor_in.out_features, critic_in.out_features], dim=-1)
+            return self.actor[1:](hidden_a).float(), self.critic[1:](hidden_c).float()
+        return self.actor(observations).float(), self.critic(critic_observations).float()
+
+    def _fused_first_layer(self, actor_in, critic_in):
+        params = (actor_in.weight, critic_in.weight, actor_in.bias, critic_in.bias)
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        if key != self._fused_in_key:
+            with torch.no_grad():
+                self._fused_in = (torch.cat(params[:2]), torch.cat(params[2:]))
+            self._fused_in_key = key
+        return self._fused_in
+
+    def act_rollout(self, observations, critic_observations):
+        """ act + evaluate + get_actions_log_prob in one call, for rollout collection.
+            Returns actions, values, actions log-prob, action mean and action std.
+        """
+        mean, values = self.rollout_forward(observations, critic_observations)
+        mean = torch.nan_to_num(mean, nan=0.0, posinf=1e3, neginf=-1e3)
+        std = torch.exp(self.std.clamp(min=-20, max=2)).expand_as(mean)
+        actions = mean + std * torch.randn_like(mean)
+        # Normal.log_prob
+        log_prob = -((actions - mean) ** 2) / (2 * std ** 2) - std.log() - math.log(math.sqrt(2 * math.pi))
+        return actions, values, log_prob.sum(dim=-1), mean, std
+
+    def act_into(self, observations, critic_observations, actions, values, actions_log_prob, action_mean, action_std):
+        """ act_rollout written into the given tensors (the rollout storage slots of the current step). """
+        if self.compile_rollout:
+            outputs = _compiled_act_rollout(type(self))(self, observations, critic_observations)
+            for out, value in zip((actions, values, actions_log_prob, action_mean, action_std), outputs):
+                out.copy_(value.view(out.shape))
+            return
+
+        # eager: sample and evaluate the log-prob in place
+        mean, value = self.rollout_forward(observations, critic_observations)
+        action_mean.copy_(mean)
+        action_mean.nan_to_num_(nan=0.0, posinf=1e3, neginf=-1e3)
+        std = torch.exp(self.std.clamp(min=-20, max=2))
+        action_std.copy_(std.expand_as(action_std))
+        actions.normal_().mul_(std).add_(action_mean)
+        # Normal.log_prob, with the per-action terms computed once for all envs
+        log_prob = torch.sub(actions, action_mean).square_().neg_().div_(2 * std ** 2)
+        log_prob.sub_(std.log()).sub_(math.log(math.sqrt(2 * math.pi)))
+        torch.sum(log_prob, dim=-1, keepdim=True, out=actions_log_prob)
+        values.copy_(value)
+
     def act_inference(self, observations):
         actions_mean = self.actor(observations)
         return actions_mean
 
     def evaluate(self, critic_observations, **kwargs):
-        value = self.critic(critic_observations)
+        value = self.critic(critic_observations).float()
         return value
 
 
+_compiled = dict()
+
+
+def _compiled_act_rollout(module_class):
+    # compiled once per class, outside the module so that it stays deepcopy- and picklable
+    if module_class not in _compiled:
+        _compiled[module_class] = torch.compile(module_class.act_rollout, dynamic=False)
+    return _compiled[module_class]
+
+
 def get_activation(act_name):
     if act_name == "elu":
         return nn.ELU()
@@ -49,6 +49,8 @@ class ActorCriticRecurrent(ActorCritic):
                         rnn_hidden_size=256,
                         rnn_num_layers=1,
                         init_noise_std=1.0,
+                        diag_gaussian=False,
+                        compile_rollout=False,
                         **kwargs):
         if kwargs:
             print("ActorCriticRecurrent.__init__ got unexpected arguments, which will be ignored: " + str(kwargs.keys()),)
@@ -59,7 +61,9 @@ class ActorCriticRecurrent(ActorCritic):
                          actor_hidden_dims=actor_hidden_dims,
                          critic_hidden_dims=critic_hidden_dims,
                          activation=activation,
-                         init_noise_std=init_noise_std)
+                         init_noise_std=init_noise_std,
+                         diag_gaussian=diag_gaussian,
+                         compile_rollout=compile_rollout)
 
         activation = get_activation(activation)
 
@@ -77,6 +81,11 @@ class ActorCriticRecurrent(ActorCritic):
         input_a = self.memory_a(observations, masks, hidden_states)
         return super().act(input_a.squeeze(0))
 
+    def rollout_forward(self, observations, critic_observations):
+        input_a = self.memory_a(observations)
+        input_c = self.memory_c(critic_observations)
+        return super().rollout_forward(input_a.squeeze(0), input_c.squeeze(0))
+
     def act_inference(self, observations):
         input_a = self.memory_a(observations)
         return super().act_inference(input_a.squeeze(0))
@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Copyright (c) 2021 ETH Zurich, Nikita Rudin
+
+import math
+
+import torch
+
+
+class DiagGaussian:
+    """ Diagonal Gaussian action distribution with a state-independent log-std, in closed form.
+        Drop-in for the subset of torch.distributions.Normal used by ActorCritic; one instance is updated
+        in place every step, and the per-action terms that only depend on the log-std are computed once
+        per update instead of once per sample.
+    """
+
+    def __init__(self):
+        self.mean = None
+        self.log_std = None
+        self.std = None
+
+    def update(self, mean, log_std):
+        self.mean = mean
+        self.log_std = log_std
+        self.std = torch.exp(log_std)
+
+    @property
+    def stddev(self):
+        return self.std.expand_as(self.mean)
+
+    def sample(self):
+        with torch.no_grad():
+            return self.rsample()
+
+    def rsample(self):
+        return self.mean + self.std * torch.randn_like(self.mean)
+
+    def log_prob(self, actions):
+        # elementwise like Normal.log_prob, so that log_prob(actions).sum(dim=-1) is the joint log-prob
+        return -((actions - self.mean) ** 2) / (2 * self.std ** 2) - self.log_std - 0.5 * math.log(2 * math.pi)
+
+    def entropy(self):
+        return (0.5 + 0.5 * math.log(2 * math.pi) + self.log_std).expand_as(self.mean)
+
+    def kl(self, old_mean, old_std):
+        return kl_divergence(self.mean, self.std, old_mean, old_std)
+
+
+def kl_divergence(mean, std, old_mean, old_std):
+    """ KL(old || current) of diagonal Gaussians summed over actions, as used by the adaptive lr schedule. """
+    return torch.sum(
+        torch.log(std / old_std + 1.e-5) + (torch.square(old_std) + torch.square(old_mean - mean))
+        / (2.0 * torch.square(std)) - 0.5, axis=-1)
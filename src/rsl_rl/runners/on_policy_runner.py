@@ -30,15 +30,16 @@
 
 import time
 import os
-from collections import deque
-import statistics
+import random
+
+import numpy as np
 
-from torch.utils.tensorboard import SummaryWriter
 import torch
 
 from rsl_rl.algorithms import PPO
 from rsl_rl.modules import ActorCritic, ActorCriticRecurrent
 from rsl_rl.env import VecEnv
+from rsl_rl.utils import CheckpointManager, EpisodeStatistics, make_metrics_sink, phase, phase_profiler
 
 
 class OnPolicyRunner:
@@ -69,21 +70,48 @@ class OnPolicyRunner:
         self.save_interval = self.cfg["save_interval"]
 
         # init storage and model
-        self.alg.init_storage(self.env.num_envs, self.num_steps_per_env, [self.env.num_obs], [self.env.num_privileged_obs], [self.env.num_actions])
+        # envs that mask samples (deferred resets) report them in extras["masked_envs"]
+        sample_mask = 'masked_envs' in getattr(self.env, 'extras', dict())
+        self.alg.init_storage(self.env.num_envs, self.num_steps_per_env, [self.env.num_obs], [self.env.num_privileged_obs], [self.env.num_actions],
+                              sample_mask=sample_mask)
 
         # Log
         self.log_dir = log_dir
-        self.writer = None
+        self.metrics = None
+        # metrics are written every iteration, the console summary every log_interval iterations
+        self.log_interval = self.cfg.get("log_interval", 1)
+        # phase profiling window: profile_iterations iterations, starting profile_start iterations into learn()
+        self.profile_start = self.cfg.get("profile_start", 10)
+        self.profile_iterations = self.cfg.get("profile_iterations", 0)
+        self.profile_trace = self.cfg.get("profile_trace", True)
         self.tot_timesteps = 0
         self.tot_time = 0
         self.current_learning_iteration = 0
+        # checkpoints are written in the background, keeping the last K and the best by mean reward; the
+        # checkpoints already in log_dir (e.g. the one a run resumes from) are only pruned on request
+        prune_existing = log_dir is not None and self.cfg.get("prune_existing_checkpoints", False)
+        self.checkpoints = CheckpointManager(self.cfg.get("keep_last_checkpoints", 0), self.cfg.get("keep_best_checkpoints", 0),
+                                             log_dir if prune_existing else None)
+        self.mean_reward = None
+        # env state in the checkpoints: "final" (the one at the end of learn()), "always" or "never"
+        self.save_env_state = self.cfg.get("save_env_state", "final")
+        self.episode_statistics = EpisodeStatistics(self.env.num_envs, 100, self.device)
 
         _, _ = self.env.reset()
     
     def learn(self, num_learning_iterations, init_at_random_ep_len=False):
-        # initialize writer
-        if self.log_dir is not None and self.writer is None:
-            self.writer = SummaryWriter(log_dir=self.log_dir, flush_secs=10)
+        # initialize metrics sink
+        if self.log_dir is not None and self.metrics is None:
+            self.metrics = make_metrics_sink(self.cfg.get("metrics_backend", "tensorboard"), self.log_dir)
+        try:
+            self._learn(num_learning_iterations, init_at_random_ep_len)
+        finally:
+            # write out the pending metrics and stop the writer, also when training stops with an error
+            if self.metrics is not None:
+                self.metrics.close()
+                self.metrics = None
+
+    def _learn(self, num_learning_iterations, init_at_random_ep_len):
         if init_at_random_ep_len:
             self.env.episode_length_buf = torch.randint_like(self.env.episode_length_buf, high=int(self.env.max_episode_length))
         obs = self.env.get_observations()
@@ -92,102 +120,118 @@ class OnPolicyRunner:
         obs, critic_obs = obs.to(self.device), critic_obs.to(self.device)
         self.alg.actor_critic.train() # switch to train mode (for dropout for example)
 
-        ep_infos = []
-        rewbuffer = deque(maxlen=100)
-        lenbuffer = deque(maxlen=100)
-        cur_reward_sum = torch.zeros(self.env.num_envs, dtype=torch.float, device=self.device)
-        cur_episode_length = torch.zeros(self.env.num_envs, dtype=torch.float, device=self.device)
-
         tot_iter = self.current_learning_iteration + num_learning_iterations
+        profile_start = self.current_learning_iteration + self.profile_start
+        profile_stop = min(profile_start + self.profile_iterations, tot_iter)
         for it in range(self.current_learning_iteration, tot_iter):
+            if it == profile_start and profile_start < profile_stop:
+                phase_profiler.start(self.device, trace=self.profile_trace)
             start = time.time()
             # Rollout
             with torch.inference_mode():
                 for i in range(self.num_steps_per_env):
-                    actions = self.alg.act(obs, critic_obs)
-                    obs, privileged_obs, rewards, dones, infos = self.env.step(actions)
+                    with phase('rollout.policy'):
+                        actions = self.alg.act(obs, critic_obs)
+                    with phase('rollout.env_step'):
+                        obs, privileged_obs, rewards, dones, infos = self.env.step(actions)
                     critic_obs = privileged_obs if privileged_obs is not None else obs
                     obs, critic_obs, rewards, dones = obs.to(self.device), critic_obs.to(self.device), rewards.to(self.device), dones.to(self.device)
-                    self.alg.process_env_step(rewards, dones, infos)
+                    with phase('rollout.storage'):
+                        self.alg.process_env_step(rewards, dones, infos)
                     
                     if self.log_dir is not None:
-                        # Book keeping
+                        # Book keeping, on device until log()
                         if 'episode' in infos:
-                            ep_infos.append(infos['episode'])
-                        cur_reward_sum += rewards
-                        cur_episode_length += 1
-                        new_ids = (dones > 0).nonzero(as_tuple=False)
-                        rewbuffer.extend(cur_reward_sum[new_ids][:, 0].cpu().numpy().tolist())
-                        lenbuffer.extend(cur_episode_length[new_ids][:, 0].cpu().numpy().tolist())
-                        cur_reward_sum[new_ids] = 0
-                        cur_episode_length[new_ids] = 0
+                            self.episode_statistics.add_infos(infos['episode'])
+                        finished = None
+                        if 'masked_envs' in infos:
+                            # envs waiting for a deferred reset report done every step, but end no episode
+                            finished = (dones > 0) & ~infos['masked_envs'].to(self.device)
+                        self.episode_statistics.step(rewards, dones, finished)
 
                 stop = time.time()
                 collection_time = stop - start
 
                 # Learning step
                 start = stop
-                self.alg.compute_returns(critic_obs)
+                with phase('update.gae'):
+                    self.alg.compute_returns(critic_obs)
             
             mean_value_loss, mean_surrogate_loss = self.alg.update()
             stop = time.time()
             learn_time = stop - start
             if self.log_dir is not None:
-                self.log(locals())
-            if it % self.save_interval == 0:
-                self.save(os.path.join(self.log_dir, 'model_{}.pt'.format(it)))
-            ep_infos.clear()
-        
-        self.current_learning_iteration += num_learning_iterations
-        self.save(os.path.join(self.log_dir, 'model_{}.pt'.format(self.current_learning_iteration)))
+                with phase('log'):
+                    self.log(locals())
+            if it == profile_stop - 1 and phase_profiler.enabled:
+                self._write_profile(profile_stop - profile_start)
+            # a checkpoint is named after the number of completed iterations it stores, the iteration it resumes at
+            self.current_learning_iteration = it + 1
+            if self.current_learning_iteration % self.save_interval == 0:
+                self.save(os.path.join(self.log_dir, 'model_{}.pt'.format(self.current_learning_iteration)),
+                          env_state=self.save_env_state == "always")
+
+        self.save(os.path.join(self.log_dir, 'model_{}.pt'.format(self.current_learning_iteration)),
+                  env_state=self.save_env_state != "never")
+        self.checkpoints.wait()
 
     def log(self, locs, width=80, pad=35):
         self.tot_timesteps += self.num_steps_per_env * self.env.num_envs
         self.tot_time += locs['collection_time'] + locs['learn_time']
         iteration_time = locs['collection_time'] + locs['learn_time']
 
-        ep_string = f''
-        if locs['ep_infos']:
-            for key in locs['ep_infos'][0]:
-                infotensor = torch.tensor([], device=self.device)
-                for ep_info in locs['ep_infos']:
-                    # handle scalar and zero dimensional tensor infos
-                    if not isinstance(ep_info[key], torch.Tensor):
-                        ep_info[key] = torch.Tensor([ep_info[key]])
-                    if len(ep_info[key].shape) == 0:
-                        ep_info[key] = ep_info[key].unsqueeze(0)
-                    infotensor = torch.cat((infotensor, ep_info[key].to(self.device)))
-                value = torch.mean(infotensor)
-                self.writer.add_scalar('Episode/' + key, value, locs['it'])
-                ep_string += f"""{f'Mean episode {key}:':>{pad}} {value:.4f}\n"""
-        mean_std = self.alg.actor_critic.std.mean()
+        # the single host transfer of the episode statistics of this iteration
+        stats = self.episode_statistics.reduce()
+        mean_std = self.alg.actor_critic.std.mean().item()
         fps = int(self.num_steps_per_env * self.env.num_envs / (locs['collection_time'] + locs['learn_time']))
 
-        self.writer.add_scalar('Loss/value_function', locs['mean_value_loss'], locs['it'])
-        self.writer.add_scalar('Loss/surrogate', locs['mean_surrogate_loss'], locs['it'])
-        self.writer.add_scalar('Loss/learning_rate', self.alg.learning_rate, locs['it'])
-        self.writer.add_scalar('Policy/mean_noise_std', mean_std.item(), locs['it'])
-        self.writer.add_scalar('Perf/total_fps', fps, locs['it'])
-        self.writer.add_scalar('Perf/collection time', locs['collection_time'], locs['it'])
-        self.writer.add_scalar('Perf/learning_time', locs['learn_time'], locs['it'])
-        if len(locs['rewbuffer']) > 0:
-            self.writer.add_scalar('Train/mean_reward', statistics.mean(locs['rewbuffer']), locs['it'])
-            self.writer.add_scalar('Train/mean_episode_length', statistics.mean(locs['lenbuffer']), locs['it'])
-            self.writer.add_scalar('Train/mean_reward/time', statistics.mean(locs['rewbuffer']), self.tot_time)
-            self.writer.add_scalar('Train/mean_episode_length/time', statistics.mean(locs['lenbuffer']), self.tot_time)
-
-        str = f" \033[1m Learning iteration {locs['it']}/{self.current_learning_iteration + locs['num_learning_iterations']} \033[0m "
-
-        if len(locs['rewbuffer']) > 0:
+        # one batch per iteration, the sink writes it off the training thread
+        scalars = {'Episode/' + key: value for key, value in stats['episode'].items()}
+        scalars.update({
+            'Loss/value_function': locs['mean_value_loss'],
+            'Loss/surrogate': locs['mean_surrogate_loss'],
+            'Loss/learning_rate': self.alg.learning_rate,
+            'Policy/mean_noise_std': mean_std,
+            'Perf/total_fps': fps,
+            'Perf/collection time': locs['collection_time'],
+            'Perf/learning_time': locs['learn_time'],
+            'Perf/total_time': self.tot_time,
+        })
+        if self.checkpoints.save_latency is not None:
+            scalars['Perf/save_latency'] = self.checkpoints.save_latency
+        if self.checkpoints.write_time is not None:
+            scalars['Perf/checkpoint_write_time'] = self.checkpoints.write_time
+        histograms = dict()
+        self.mean_reward = stats['mean_reward']
+        if stats['mean_reward'] is not None:
+            scalars['Train/mean_reward'] = stats['mean_reward']
+            scalars['Train/mean_episode_length'] = stats['mean_episode_length']
+            histograms['Train/episode_return'] = stats['returns']
+            histograms['Train/episode_length'] = stats['lengths']
+        self.metrics.write(locs['it'], scalars, histograms)
+        if stats['mean_reward'] is not None:
+            self.metrics.write_time(self.tot_time, {
+                'Train/mean_reward/time': stats['mean_reward'],
+                'Train/mean_episode_length/time': stats['mean_episode_length'],
+            })
+
+        if locs['it'] % self.log_interval != 0 and locs['it'] != locs['tot_iter'] - 1:
+            return
+        ep_string = f''
+        for key, value in stats['episode'].items():
+            ep_string += f"""{f'Mean episode {key}:':>{pad}} {value:.4f}\n"""
+        str = f" \033[1m Learning iteration {locs['it']}/{locs['tot_iter']} \033[0m "
+
+        if stats['mean_reward'] is not None:
             log_string = (f"""{'#' * width}\n"""
                           f"""{str.center(width, ' ')}\n\n"""
                           f"""{'Computation:':>{pad}} {fps:.0f} steps/s (collection: {locs[
                             'collection_time']:.3f}s, learning {locs['learn_time']:.3f}s)\n"""
                           f"""{'Value function loss:':>{pad}} {locs['mean_value_loss']:.4f}\n"""
                           f"""{'Surrogate loss:':>{pad}} {locs['mean_surrogate_loss']:.4f}\n"""
-                          f"""{'Mean action noise std:':>{pad}} {mean_std.item():.2f}\n"""
-                          f"""{'Mean reward:':>{pad}} {statistics.mean(locs['rewbuffer']):.2f}\n"""
-                          f"""{'Mean episode length:':>{pad}} {statistics.mean(locs['lenbuffer']):.2f}\n""")
+                          f"""{'Mean action noise std:':>{pad}} {mean_std:.2f}\n"""
+                          f"""{'Mean reward:':>{pad}} {stats['mean_reward']:.2f}\n"""
+                          f"""{'Mean episode length:':>{pad}} {stats['mean_episode_length']:.2f}\n""")
                         #   f"""{'Mean reward/step:':>{pad}} {locs['mean_reward']:.2f}\n"""
                         #   f"""{'Mean episode length/episode:':>{pad}} {locs['mean_trajectory_length']:.2f}\n""")
         else:
@@ -197,7 +241,7 @@ class OnPolicyRunner:
                             'collection_time']:.3f}s, learning {locs['learn_time']:.3f}s)\n"""
                           f"""{'Value function loss:':>{pad}} {locs['mean_value_loss']:.4f}\n"""
                           f"""{'Surrogate loss:':>{pad}} {locs['mean_surrogate_loss']:.4f}\n"""
-                          f"""{'Mean action noise std:':>{pad}} {mean_std.item():.2f}\n""")
+                          f"""{'Mean action noise std:':>{pad}} {mean_std:.2f}\n""")
                         #   f"""{'Mean reward/step:':>{pad}} {locs['mean_reward']:.2f}\n"""
                         #   f"""{'Mean episode length/episode:':>{pad}} {locs['mean_trajectory_length']:.2f}\n""")
 
@@ -207,25 +251,93 @@ class OnPolicyRunner:
                        f"""{'Iteration time:':>{pad}} {iteration_time:.2f}s\n"""
                        f"""{'Total time:':>{pad}} {self.tot_time:.2f}s\n"""
                        f"""{'ETA:':>{pad}} {self.tot_time / (locs['it'] + 1) * (
-                               locs['num_learning_iterations'] - locs['it']):.1f}s\n""")
+                               locs['tot_iter'] - locs['it'] - 1):.1f}s\n""")
         print(log_string)
 
-    def save(self, path, infos=None):
-        torch.save({
+    def save(self, path, infos=None, env_state=True):
+        # the env state is read back on the training thread (the simulator is not thread safe)
+        self.checkpoints.save(path, {
             'model_state_dict': self.alg.actor_critic.state_dict(),
             'optimizer_state_dict': self.alg.optimizer.state_dict(),
             'iter': self.current_learning_iteration,
             'infos': infos,
-            }, path)
+            'training_state': self.get_training_state(env_state),
+            }, reward=self.mean_reward)
 
-    def load(self, path, load_optimizer=True):
-        loaded_dict = torch.load(path)
+    def load(self, path, load_optimizer=True, load_training_state=False):
+        """ path is a checkpoint file or a checkpoint dict that was already loaded. """
+        loaded_dict = path if isinstance(path, dict) else torch.load(path, weights_only=False)
         self.alg.actor_critic.load_state_dict(loaded_dict['model_state_dict'])
         if load_optimizer:
             self.alg.optimizer.load_state_dict(loaded_dict['optimizer_state_dict'])
         self.current_learning_iteration = loaded_dict['iter']
+        if load_training_state and 'training_state' in loaded_dict:
+            self.set_training_state(loaded_dict['training_state'])
         return loaded_dict['infos']
 
+    def _write_profile(self, num_iterations):
+        trace_path = os.path.join(self.log_dir, 'trace.json') if self.log_dir is not None else None
+        summary = phase_profiler.stop(num_iterations, trace_path)
+        print(summary)
+        if self.log_dir is not None:
+            with open(os.path.join(self.log_dir, 'profile.txt'), 'w') as f:
+                f.write(summary + '\n')
+
+    def get_training_state(self, env_state=True):
+        """ Everything besides the model and optimizer that an exact resume needs: the RNG states, the adaptive
+            learning rate, the logging counters, the curriculum stage, the episode statistics, the recurrent
+            hidden states and, with env_state, the env state (when the env supports get_state).
+        """
+        rng = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+        if torch.cuda.is_available():
+            rng['cuda'] = torch.cuda.get_rng_state_all()
+        if torch.backends.mps.is_available():
+            rng['mps'] = torch.mps.get_rng_state()
+        state = {
+            'rng': rng,
+            'learning_rate': self.alg.learning_rate,
+            'tot_timesteps': self.tot_timesteps,
+            'tot_time': self.tot_time,
+            'curriculum_stage': self.cfg['experiment_name'],
+            'num_envs': self.env.num_envs,
+            'episode_statistics': self.episode_statistics.state_dict(),
+        }
+        if self.alg.grad_scaler is not None:
+            state['grad_scaler'] = self.alg.grad_scaler.state_dict()
+        if self.alg.actor_critic.is_recurrent:
+            state['hidden_states'] = self.alg.actor_critic.get_hidden_states()
+        if env_state and hasattr(self.env, 'get_state'):
+            state['env'] = self.env.get_state()
+        return state
+
+    def set_training_state(self, state):
+        if state['num_envs'] != self.env.num_envs:
+            raise ValueError(f"The checkpoint was trained with {state['num_envs']} envs, "
+                             f"the env has {self.env.num_envs}")
+        torch.set_rng_state(state['rng']['torch'])
+        np.random.set_state(state['rng']['numpy'])
+        random.setstate(state['rng']['python'])
+        if 'cuda' in state['rng'] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+        if 'mps' in state['rng'] and torch.backends.mps.is_available():
+            torch.mps.set_rng_state(state['rng']['mps'])
+        self.alg.set_learning_rate(state['learning_rate'])
+        self.tot_timesteps = state['tot_timesteps']
+        self.tot_time = state['tot_time']
+        self.episode_statistics.load_state_dict(state['episode_statistics'])
+        if self.alg.grad_scaler is not None and 'grad_scaler' in state:
+            self.alg.grad_scaler.load_state_dict(state['grad_scaler'])
+        if self.alg.actor_critic.is_recurrent and 'hidden_states' in state:
+            for memory, hidden_states in zip((self.alg.actor_critic.memory_a, self.alg.actor_critic.memory_c),
+                                             state['hidden_states']):
+                if isinstance(hidden_states, tuple):
+                    hidden_states = tuple(h.to(self.device) for h in hidden_states)
+                elif hidden_states is not None:
+                    hidden_states = hidden_states.to(self.device)
+                memory.hidden_states = hidden_states
+        if hasattr(self.env, 'set_state') and 'env' in state:
+            self.env.set_state(state['env'])
+
     def get_inference_policy(self, device=None):
         self.alg.actor_critic.eval() # switch to evaluation mode (dropout for example)
         if device is not None:
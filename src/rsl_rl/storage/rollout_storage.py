@@ -31,13 +31,42 @@
 import torch
 import numpy as np
 
-from rsl_rl.utils import split_and_pad_trajectories
+from rsl_rl.utils import split_and_pad_trajectories, phase
+
+
+def generalized_advantages(rewards, values, dones, last_values, returns, advantages, weights, gamma, lam):
+    """ GAE of a [T, N, 1] rollout, written into returns and advantages; the advantages are normalized over the
+        samples with weight 1 when weights are given (and zeroed on the others), over all samples otherwise.
+        With compile_gae this function is compiled: the unrolled recursion is elementwise over the envs and fuses
+        with the normalization into a few kernels that read the rollout once.
+    """
+    num_steps = rewards.shape[0]
+    advantage = 0
+    for step in reversed(range(num_steps)):
+        if step == num_steps - 1:
+            next_values = last_values
+        else:
+            next_values = values[step + 1]
+        next_is_not_terminal = 1.0 - dones[step].float()
+        delta = rewards[step] + next_is_not_terminal * gamma * next_values - values[step]
+        advantage = delta + next_is_not_terminal * gamma * lam * advantage
+        returns[step] = advantage + values[step]
+
+    # Compute and normalize the advantages
+    torch.sub(returns, values, out=advantages)
+    if weights is not None:
+        # statistics over the unmasked samples only, the masked ones end up with zero advantage
+        num_samples = weights.sum()
+        mean = (advantages * weights).sum() / num_samples
+        std = torch.sqrt((advantages - mean).square_().mul_(weights).sum() / (num_samples - 1))
+        advantages.sub_(mean).div_(std + 1e-8).mul_(weights)
+    else:
+        advantages.sub_(advantages.mean()).div_(advantages.std() + 1e-8)
+
 
 class RolloutStorage:
     class Transition:
         def __init__(self):
-            self.observations = None
-            self.critic_observations = None
             self.actions = None
             self.rewards = None
             self.dones = None
@@ -46,11 +75,13 @@ class RolloutStorage:
             self.action_mean = None
             self.action_sigma = None
             self.hidden_states = None
+            self.masked = None
         
         def clear(self):
             self.__init__()
 
-    def __init__(self, num_envs, num_transitions_per_env, obs_shape, privileged_obs_shape, actions_shape, device='cpu'):
+    def __init__(self, num_envs, num_transitions_per_env, obs_shape, privileged_obs_shape, actions_shape, device='cpu',
+                 compressed_dtype=None, sample_mask=False, compile_gae=False):
 
         self.device = device
 
@@ -59,22 +90,48 @@ class RolloutStorage:
         self.actions_shape = actions_shape
 
         # Core
-        self.observations = torch.zeros(num_transitions_per_env, num_envs, *obs_shape, device=self.device)
+        self.rewards = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
+        self.dones = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device, dtype=torch.bool)
+
+        # The fields sampled by the minibatches live in one contiguous [T, N, F] buffer,
+        # the tensors below (observations ... sigma) are named column views into it.
+        # With a compressed_dtype, observations and mu go to a second buffer of that dtype and are upcast in the
+        # minibatch gathers, and sigma, which does not depend on the state, is stored once per iteration
+        self.compressed_dtype = compressed_dtype
+        obs_fields = {"observations": obs_shape[0]}
         if privileged_obs_shape[0] is not None:
-            self.privileged_observations = torch.zeros(num_transitions_per_env, num_envs, *privileged_obs_shape, device=self.device)
+            obs_fields["privileged_observations"] = privileged_obs_shape[0]
+        self.fields = dict(obs_fields) if compressed_dtype is None else dict()
+        self.fields.update(actions=actions_shape[0], values=1, returns=1, actions_log_prob=1, advantages=1)
+        # with a sample_mask, the weights (0 or 1) of the samples: masked samples get no advantage and no loss
+        self.sample_mask = sample_mask
+        if sample_mask:
+            self.fields.update(weights=1)
+        self.compressed_fields = dict()
+        if compressed_dtype is None:
+            self.fields.update(mu=actions_shape[0], sigma=actions_shape[0])
         else:
-            self.privileged_observations = None
-        self.rewards = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.actions = torch.zeros(num_transitions_per_env, num_envs, *actions_shape, device=self.device)
-        self.dones = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device).byte()
-
-        # For PPO
-        self.actions_log_prob = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.values = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.returns = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.advantages = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.mu = torch.zeros(num_transitions_per_env, num_envs, *actions_shape, device=self.device)
-        self.sigma = torch.zeros(num_transitions_per_env, num_envs, *actions_shape, device=self.device)
+            self.compressed_fields = dict(obs_fields, mu=actions_shape[0])
+        self.data = torch.zeros(num_transitions_per_env, num_envs, sum(self.fields.values()), device=self.device)
+        self.compressed_data = None
+        if compressed_dtype is not None:
+            self.compressed_data = torch.zeros(num_transitions_per_env, num_envs, sum(self.compressed_fields.values()),
+                                               device=self.device, dtype=compressed_dtype)
+            self.sigma = torch.zeros(actions_shape[0], device=self.device)
+            # fp32 policy outputs of the current step (write-through), compressed by add_rewards_and_dones
+            self.step_mu = torch.zeros(num_envs, actions_shape[0], device=self.device)
+            self.step_sigma = torch.zeros(num_envs, actions_shape[0], device=self.device)
+        self.privileged_observations = None
+        for buffer, fields in ((self.data, self.fields), (self.compressed_data, self.compressed_fields)):
+            if fields:
+                for name, column in zip(fields, torch.split(buffer, list(fields.values()), dim=-1)):
+                    setattr(self, name, column)
+        self.minibatch_data = None  # rows of data gathered for the current minibatch, allocated on first use
+        self.minibatch_compressed = None
+        # compiled GAE (once for the static rollout shape) agrees with the eager step loop up to float rounding
+        self._generalized_advantages = generalized_advantages
+        if compile_gae:
+            self._generalized_advantages = torch.compile(generalized_advantages, dynamic=False)
 
         self.num_transitions_per_env = num_transitions_per_env
         self.num_envs = num_envs
@@ -85,21 +142,63 @@ class RolloutStorage:
 
         self.step = 0
 
+    def add_observations(self, observations, critic_observations):
+        if self.step >= self.num_transitions_per_env:
+            raise AssertionError("Rollout buffer overflow")
+        self.observations[self.step].copy_(observations)
+        if self.privileged_observations is not None: self.privileged_observations[self.step].copy_(critic_observations)
+
     def add_transitions(self, transition: Transition):
         if self.step >= self.num_transitions_per_env:
             raise AssertionError("Rollout buffer overflow")
-        self.observations[self.step].copy_(transition.observations)
-        if self.privileged_observations is not None: self.privileged_observations[self.step].copy_(transition.critic_observations)
         self.actions[self.step].copy_(transition.actions)
         self.rewards[self.step].copy_(transition.rewards.view(-1, 1))
         self.dones[self.step].copy_(transition.dones.view(-1, 1))
         self.values[self.step].copy_(transition.values)
         self.actions_log_prob[self.step].copy_(transition.actions_log_prob.view(-1, 1))
-        self.mu[self.step].copy_(transition.action_mean)
-        self.sigma[self.step].copy_(transition.action_sigma)
+        self._add_weights(transition.masked)
+        if self.compressed_dtype is None:
+            self.mu[self.step].copy_(transition.action_mean)
+            self.sigma[self.step].copy_(transition.action_sigma)
+        else:
+            self._add_distribution(transition.action_mean, transition.action_sigma)
         self._save_hidden_states(transition.hidden_states)
         self.step += 1
 
+    def add_rewards_and_dones(self, rewards, dones, hidden_states=None, masked=None):
+        # write-through counterpart of add_transitions: the policy outputs of this step are already in place
+        if self.step >= self.num_transitions_per_env:
+            raise AssertionError("Rollout buffer overflow")
+        self.rewards[self.step].copy_(rewards.view(-1, 1))
+        self.dones[self.step].copy_(dones.view(-1, 1))
+        self._add_weights(masked)
+        if self.compressed_dtype is not None:
+            self._add_distribution(self.step_mu, self.step_sigma)
+        self._save_hidden_states(hidden_states)
+        self.step += 1
+
+    def policy_slots(self):
+        """ Tensors the policy outputs of the current step are written into: actions, values, actions log-prob, mu and sigma. """
+        if self.step >= self.num_transitions_per_env:
+            raise AssertionError("Rollout buffer overflow")
+        step = self.step
+        if self.compressed_dtype is None:
+            return self.actions[step], self.values[step], self.actions_log_prob[step], self.mu[step], self.sigma[step]
+        return self.actions[step], self.values[step], self.actions_log_prob[step], self.step_mu, self.step_sigma
+
+    def _add_weights(self, masked):
+        if not self.sample_mask:
+            return
+        if masked is None:
+            self.weights[self.step].fill_(1.0)
+        else:
+            torch.logical_not(masked.view(-1, 1), out=self.weights[self.step])
+
+    def _add_distribution(self, mu, sigma):
+        self.mu[self.step].copy_(mu)
+        if self.step == 0:
+            self.sigma.copy_(sigma[0])
+
     def _save_hidden_states(self, hidden_states):
         if hidden_states is None or hidden_states==(None, None):
             return
@@ -121,20 +220,21 @@ class RolloutStorage:
         self.step = 0
 
     def compute_returns(self, last_values, gamma, lam):
-        advantage = 0
-        for step in reversed(range(self.num_transitions_per_env)):
-            if step == self.num_transitions_per_env - 1:
-                next_values = last_values
-            else:
-                next_values = self.values[step + 1]
-            next_is_not_terminal = 1.0 - self.dones[step].float()
-            delta = self.rewards[step] + next_is_not_terminal * gamma * next_values - self.values[step]
-            advantage = delta + next_is_not_terminal * gamma * lam * advantage
-            self.returns[step] = advantage + self.values[step]
-
-        # Compute and normalize the advantages
-        self.advantages = self.returns - self.values
-        self.advantages = (self.advantages - self.advantages.mean()) / (self.advantages.std() + 1e-8)
+        self._generalized_advantages(self.rewards, self.values, self.dones, last_values, self.returns, self.advantages,
+                                     self.weights if self.sample_mask else None, gamma, lam)
+
+    def memory_usage(self):
+        """ Bytes held per field, with the scratch buffers of the minibatch gathers. """
+        usage = {name: getattr(self, name).nbytes for name in list(self.fields) + list(self.compressed_fields)}
+        if self.compressed_dtype is not None:
+            usage["sigma"] = self.sigma.nbytes + self.step_mu.nbytes + self.step_sigma.nbytes
+        usage.update(rewards=self.rewards.nbytes, dones=self.dones.nbytes)
+        for name in ("minibatch_data", "minibatch_compressed"):
+            if getattr(self, name) is not None:
+                usage[name] = getattr(self, name).nbytes
+        if self.saved_hidden_states_a is not None:
+            usage["hidden_states"] = sum(h.nbytes for h in self.saved_hidden_states_a + self.saved_hidden_states_c)
+        return usage
 
     def get_statistics(self):
         done = self.dones
@@ -147,89 +247,97 @@ class RolloutStorage:
     def mini_batch_generator(self, num_mini_batches, num_epochs=8):
         batch_size = self.num_envs * self.num_transitions_per_env
         mini_batch_size = batch_size // num_mini_batches
-        indices = torch.randperm(num_mini_batches*mini_batch_size, requires_grad=False, device=self.device)
-
-        observations = self.observations.flatten(0, 1)
-        if self.privileged_observations is not None:
-            critic_observations = self.privileged_observations.flatten(0, 1)
-        else:
-            critic_observations = observations
-
-        actions = self.actions.flatten(0, 1)
-        values = self.values.flatten(0, 1)
-        returns = self.returns.flatten(0, 1)
-        old_actions_log_prob = self.actions_log_prob.flatten(0, 1)
-        advantages = self.advantages.flatten(0, 1)
-        old_mu = self.mu.flatten(0, 1)
-        old_sigma = self.sigma.flatten(0, 1)
+        data = self.data.flatten(0, 1)
+        if self.minibatch_data is None or self.minibatch_data.shape[0] != mini_batch_size:
+            self.minibatch_data = torch.empty(mini_batch_size, data.shape[1], device=self.device)
+            if self.compressed_data is not None:
+                self.minibatch_compressed = torch.empty(mini_batch_size, self.compressed_data.shape[-1],
+                                                        device=self.device, dtype=self.compressed_dtype)
 
         for epoch in range(num_epochs):
+            indices = torch.randperm(num_mini_batches*mini_batch_size, requires_grad=False, device=self.device)
             for i in range(num_mini_batches):
 
                 start = i*mini_batch_size
                 end = (i+1)*mini_batch_size
-                batch_idx = indices[start:end]
-
-                obs_batch = observations[batch_idx]
-                critic_observations_batch = critic_observations[batch_idx]
-                actions_batch = actions[batch_idx]
-                target_values_batch = values[batch_idx]
-                returns_batch = returns[batch_idx]
-                old_actions_log_prob_batch = old_actions_log_prob[batch_idx]
-                advantages_batch = advantages[batch_idx]
-                old_mu_batch = old_mu[batch_idx]
-                old_sigma_batch = old_sigma[batch_idx]
-                yield obs_batch, critic_observations_batch, actions_batch, target_values_batch, advantages_batch, returns_batch, \
-                       old_actions_log_prob_batch, old_mu_batch, old_sigma_batch, (None, None), None
+                with phase('update.minibatch_gather'):
+                    # one gather of all fields per minibatch into a buffer that is reused by the next minibatch
+                    batch_idx = indices[start:end]
+                    torch.index_select(data, 0, batch_idx, out=self.minibatch_data)
+                    columns = torch.split(self.minibatch_data, list(self.fields.values()), dim=-1)
+                    batch = dict(zip(self.fields, columns))
+                    if self.compressed_data is not None:
+                        torch.index_select(self.compressed_data.flatten(0, 1), 0, batch_idx, out=self.minibatch_compressed)
+                        upcast = self.minibatch_compressed.float()
+                        batch.update(zip(self.compressed_fields, torch.split(upcast, list(self.compressed_fields.values()), dim=-1)))
+                        batch["sigma"] = self.sigma.expand(end - start, -1)
+
+                obs_batch = batch["observations"]
+                critic_observations_batch = batch.get("privileged_observations", obs_batch)
+                yield obs_batch, critic_observations_batch, batch["actions"], batch["values"], batch["advantages"], \
+                       batch["returns"], batch["actions_log_prob"], batch["mu"], batch["sigma"], (None, None), None, \
+                       batch.get("weights")
 
     # for RNNs only
     def reccurent_mini_batch_generator(self, num_mini_batches, num_epochs=8):
-
+        # the trajectory split, padding masks, minibatch trajectory ranges and hidden-state gathers depend only on
+        # the rollout: computed once here and reused by every epoch
         padded_obs_trajectories, trajectory_masks = split_and_pad_trajectories(self.observations, self.dones)
+        padded_obs_trajectories = padded_obs_trajectories.float()
         if self.privileged_observations is not None: 
             padded_critic_obs_trajectories, _ = split_and_pad_trajectories(self.privileged_observations, self.dones)
+            padded_critic_obs_trajectories = padded_critic_obs_trajectories.float()
         else: 
             padded_critic_obs_trajectories = padded_obs_trajectories
 
         mini_batch_size = self.num_envs // num_mini_batches
+        dones = self.dones.squeeze(-1)
+        last_was_done = torch.zeros_like(dones, dtype=torch.bool)
+        last_was_done[1:] = dones[:-1]
+        last_was_done[0] = True
+        # trajectories are ordered env-major, so a minibatch of envs is a contiguous range of trajectories
+        trajectory_counts = last_was_done[:, :num_mini_batches * mini_batch_size].sum(dim=0)
+        trajectory_bounds = [0] + torch.cumsum(trajectory_counts.view(num_mini_batches, mini_batch_size).sum(dim=1), dim=0).tolist()
+
+        # reshape to [num_envs, time, num layers, hidden dim] (original shape: [time, num_layers, num_envs, hidden_dim])
+        # then take only time steps after dones (flattens num envs and time dimensions)
+        # and reshape to [num_layers, trajectories, hidden_dim]
+        last_was_done = last_was_done.permute(1, 0)
+        hid_a = [ saved_hidden_states.permute(2, 0, 1, 3)[last_was_done].transpose(1, 0).contiguous()
+                  for saved_hidden_states in self.saved_hidden_states_a ]
+        hid_c = [ saved_hidden_states.permute(2, 0, 1, 3)[last_was_done].transpose(1, 0).contiguous()
+                  for saved_hidden_states in self.saved_hidden_states_c ]
+
         for ep in range(num_epochs):
-            first_traj = 0
             for i in range(num_mini_batches):
                 start = i*mini_batch_size
                 stop = (i+1)*mini_batch_size
-
-                dones = self.dones.squeeze(-1)
-                last_was_done = torch.zeros_like(dones, dtype=torch.bool)
-                last_was_done[1:] = dones[:-1]
-                last_was_done[0] = True
-                trajectories_batch_size = torch.sum(last_was_done[:, start:stop])
-                last_traj = first_traj + trajectories_batch_size
-                
-                masks_batch = trajectory_masks[:, first_traj:last_traj]
-                obs_batch = padded_obs_trajectories[:, first_traj:last_traj]
-                critic_obs_batch = padded_critic_obs_trajectories[:, first_traj:last_traj]
-
-                actions_batch = self.actions[:, start:stop]
-                old_mu_batch = self.mu[:, start:stop]
-                old_sigma_batch = self.sigma[:, start:stop]
-                returns_batch = self.returns[:, start:stop]
-                advantages_batch = self.advantages[:, start:stop]
-                values_batch = self.values[:, start:stop]
-                old_actions_log_prob_batch = self.actions_log_prob[:, start:stop]
-
-                # reshape to [num_envs, time, num layers, hidden dim] (original shape: [time, num_layers, num_envs, hidden_dim])
-                # then take only time steps after dones (flattens num envs and time dimensions),
-                # take a batch of trajectories and finally reshape back to [num_layers, batch, hidden_dim]
-                last_was_done = last_was_done.permute(1, 0)
-                hid_a_batch = [ saved_hidden_states.permute(2, 0, 1, 3)[last_was_done][first_traj:last_traj].transpose(1, 0).contiguous()
-                                for saved_hidden_states in self.saved_hidden_states_a ] 
-                hid_c_batch = [ saved_hidden_states.permute(2, 0, 1, 3)[last_was_done][first_traj:last_traj].transpose(1, 0).contiguous()
-                                for saved_hidden_states in self.saved_hidden_states_c ]
-                # remove the tuple for GRU
-                hid_a_batch = hid_a_batch[0] if len(hid_a_batch)==1 else hid_a_batch
-                hid_c_batch = hid_c_batch[0] if len(hid_c_batch)==1 else hid_a_batch
+                first_traj, last_traj = trajectory_bounds[i], trajectory_bounds[i + 1]
+
+                with phase('update.minibatch_gather'):
+                    masks_batch = trajectory_masks[:, first_traj:last_traj]
+                    obs_batch = padded_obs_trajectories[:, first_traj:last_traj]
+                    critic_obs_batch = padded_critic_obs_trajectories[:, first_traj:last_traj]
+
+                    actions_batch = self.actions[:, start:stop]
+                    old_mu_batch = self.mu[:, start:stop].float()
+                    if self.compressed_dtype is None:
+                        old_sigma_batch = self.sigma[:, start:stop]
+                    else:
+                        old_sigma_batch = self.sigma.expand(self.num_transitions_per_env, stop - start, -1)
+                    returns_batch = self.returns[:, start:stop]
+                    advantages_batch = self.advantages[:, start:stop]
+                    values_batch = self.values[:, start:stop]
+                    old_actions_log_prob_batch = self.actions_log_prob[:, start:stop]
+                    weights_batch = self.weights[:, start:stop] if self.sample_mask else None
+
+                    # take the batch of trajectories
+                    hid_a_batch = [ hidden_states[:, first_traj:last_traj].contiguous() for hidden_states in hid_a ]
+                    hid_c_batch = [ hidden_states[:, first_traj:last_traj].contiguous() for hidden_states in hid_c ]
+                    # remove the tuple for GRU
+                    hid_a_batch = hid_a_batch[0] if len(hid_a_batch)==1 else hid_a_batch
+                    hid_c_batch = hid_c_batch[0] if len(hid_c_batch)==1 else hid_c_batch
 
                 yield obs_batch, critic_obs_batch, actions_batch, values_batch, advantages_batch, returns_batch, \
-                       old_actions_log_prob_batch, old_mu_batch, old_sigma_batch, (hid_a_batch, hid_c_batch), masks_batch
-                
-                first_traj = last_traj
\ No newline at end of file
+                       old_actions_log_prob_batch, old_mu_batch, old_sigma_batch, (hid_a_batch, hid_c_batch), masks_batch, \
+                       weights_batch
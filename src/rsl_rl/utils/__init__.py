@@ -28,4 +28,8 @@
 #
 # Copyright (c) 2021 ETH Zurich, Nikita Rudin
 
-from .utils import split_and_pad_trajectories, unpad_trajectories
\ No newline at end of file
+from .utils import split_and_pad_trajectories, unpad_trajectories
+from .episode_statistics import EpisodeStatistics
+from .checkpoint_manager import CheckpointManager
+from .metrics import MetricsSink, TensorBoardSink, ColumnarSink, make_metrics_sink, read_columnar
+from .profiling import PhaseProfiler, phase_profiler, phase
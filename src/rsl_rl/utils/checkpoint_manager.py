@@ -0,0 +1,121 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Copyright (c) 2021 ETH Zurich, Nikita Rudin
+
+import glob
+import os
+import queue
+import re
+import threading
+import time
+
+import torch
+
+
+class CheckpointManager:
+    """ Writes checkpoints from a background thread.
+
+        save() snapshots the checkpoint to CPU on the calling thread and queues it; the writer thread saves it
+        under a temporary name and renames it into place, so a checkpoint file is either complete or absent.
+        After every write only the newest checkpoint, the keep_last most recent ones and the keep_best ones with
+        the highest reward stay on disk (keep_last=0 and keep_best=0 keep everything). Only the checkpoints this
+        manager wrote are pruned; with existing_dir, the model_*.pt files already there count as older
+        checkpoints without reward and are pruned as well.
+    """
+    def __init__(self, keep_last=0, keep_best=0, existing_dir=None):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.checkpoints = []  # (path, reward) in save order
+        if existing_dir is not None:
+            existing = dict()
+            for path in glob.glob(os.path.join(existing_dir, "model_*.pt")):
+                match = re.fullmatch(r"model_(\d+)\.pt", os.path.basename(path))
+                if match is not None:
+                    existing[path] = int(match.group(1))
+            self.checkpoints = [(path, None) for path in sorted(existing, key=existing.get)]
+        self.save_latency = None  # seconds the caller spent in the last save()
+        self.write_time = None  # seconds the writer spent on the last checkpoint
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def save(self, path, checkpoint, reward=None):
+        self._raise_error()
+        start = time.perf_counter()
+        self.queue.put((path, snapshot(checkpoint), reward))
+        self.save_latency = time.perf_counter() - start
+
+    def wait(self):
+        """ Blocks until every queued checkpoint is on disk. """
+        self.queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def _write_loop(self):
+        while True:
+            path, checkpoint, reward = self.queue.get()
+            try:
+                start = time.perf_counter()
+                tmp_path = path + ".tmp"
+                torch.save(checkpoint, tmp_path)
+                os.replace(tmp_path, path)
+                self.write_time = time.perf_counter() - start
+                self._prune(path, reward)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _prune(self, path, reward):
+        self.checkpoints = [(p, r) for p, r in self.checkpoints if p != path] + [(path, reward)]
+        if self.keep_last <= 0 and self.keep_best <= 0:
+            return
+        keep = {p for p, _ in self.checkpoints[-max(self.keep_last, 1):]}
+        rewarded = [(p, r) for p, r in self.checkpoints if r is not None]
+        keep.update(p for p, _ in sorted(rewarded, key=lambda item: item[1], reverse=True)[:self.keep_best])
+        for p, _ in self.checkpoints:
+            if p not in keep and os.path.exists(p):
+                os.remove(p)
+        self.checkpoints = [(p, r) for p, r in self.checkpoints if p in keep]
+
+
+def snapshot(obj):
+    """ Copy of a (nested) checkpoint with every tensor detached and copied to CPU. """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
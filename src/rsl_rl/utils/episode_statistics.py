@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Copyright (c) 2021 ETH Zurich, Nikita Rudin
+
+import torch
+
+
+class EpisodeStatistics:
+    """ Device-resident episode bookkeeping for the runner.
+
+        Running returns and lengths per env, ring buffers with the returns and lengths of the last finished
+        episodes, and per-term sums and counts of the env episode infos. Updating never syncs with the host,
+        reduce() copies everything to the host in a single transfer, once per iteration.
+    """
+    def __init__(self, num_envs, buffer_size=100, device='cpu'):
+        self.device = device
+        self.buffer_size = buffer_size
+        self.cur_reward_sum = torch.zeros(num_envs, device=device)
+        self.cur_episode_length = torch.zeros(num_envs, device=device)
+        # ring buffers of buffer_size slots, followed by one scratch slot per env for the envs that are not written
+        self.returns = torch.zeros(buffer_size + num_envs, device=device)
+        self.lengths = torch.zeros(buffer_size + num_envs, device=device)
+        self.num_finished = torch.zeros((), device=device, dtype=torch.long)
+        self.slots = torch.zeros(num_envs, device=device, dtype=torch.long)
+        self.scratch_slots = torch.arange(buffer_size, buffer_size + num_envs, device=device)
+        self.term_sums = dict()
+        self.term_counts = dict()
+
+    def add_infos(self, episode_infos):
+        for key, value in episode_infos.items():
+            if key not in self.term_sums:
+                self.term_sums[key] = torch.zeros((), device=self.device)
+                self.term_counts[key] = 0
+            self.term_sums[key] += torch.as_tensor(value, device=self.device, dtype=torch.float).mean()
+            self.term_counts[key] += 1
+
+    def step(self, rewards, dones, finished=None):
+        """ Adds one step of rewards. dones restart the running sums, finished (dones by default) marks the envs
+            whose episode goes into the ring buffers.
+        """
+        rewards, dones = rewards.view(-1), dones.view(-1) > 0
+        finished = dones if finished is None else finished.view(-1) > 0
+        self.cur_reward_sum += rewards
+        self.cur_episode_length += 1
+
+        # the k-th finished env of this step goes to slot (num_finished + k) % buffer_size; only the last
+        # buffer_size finished envs are written there and every other env writes its own scratch slot, so the
+        # indices are unique and index_copy_ is deterministic on every device
+        torch.cumsum(finished, dim=0, out=self.slots)
+        num_new = self.slots[-1].clone()
+        written = finished & (self.slots > num_new - self.buffer_size)
+        self.slots.add_(self.num_finished - 1).remainder_(self.buffer_size)
+        torch.where(written, self.slots, self.scratch_slots, out=self.slots)
+        self.returns.index_copy_(0, self.slots, self.cur_reward_sum)
+        self.lengths.index_copy_(0, self.slots, self.cur_episode_length)
+        self.num_finished += num_new
+
+        self.cur_reward_sum.masked_fill_(dones, 0.0)
+        self.cur_episode_length.masked_fill_(dones, 0.0)
+
+    def state_dict(self):
+        """ Running sums and ring buffers, the episode info terms are empty right after reduce(). """
+        state = {key: getattr(self, key) for key in ("cur_reward_sum", "cur_episode_length", "num_finished")}
+        state.update(returns=self.returns[:self.buffer_size], lengths=self.lengths[:self.buffer_size])
+        return state
+
+    def load_state_dict(self, state_dict):
+        for key, value in state_dict.items():
+            if key in ("returns", "lengths"):
+                getattr(self, key)[:self.buffer_size].copy_(value[:self.buffer_size])
+            else:
+                getattr(self, key).copy_(value)
+
+    def reduce(self):
+        """ Host copy of the statistics: the mean of every episode info term since the last call, and the returns
+            and lengths in the ring buffers with their means (None before the first episode finishes).
+        """
+        keys = list(self.term_sums)
+        term_means = [self.term_sums[key] / self.term_counts[key] for key in keys]
+        num_valid = torch.clamp(self.num_finished, max=self.buffer_size).view(1).float()
+        parts = ([torch.stack(term_means)] if term_means else []) + [num_valid, self.returns[:self.buffer_size],
+                                                                     self.lengths[:self.buffer_size]]
+        host = torch.cat(parts).cpu()
+        self.term_sums.clear()
+        self.term_counts.clear()
+
+        num_terms = len(keys)
+        num_valid = int(host[num_terms])
+        returns = host[num_terms + 1:num_terms + 1 + num_valid]
+        lengths = host[num_terms + 1 + self.buffer_size:num_terms + 1 + self.buffer_size + num_valid]
+        return {
+            "episode": dict(zip(keys, host[:num_terms].tolist())),
+            "returns": returns,
+            "lengths": lengths,
+            "mean_reward": returns.mean().item() if num_valid > 0 else None,
+            "mean_episode_length": lengths.mean().item() if num_valid > 0 else None,
+        }
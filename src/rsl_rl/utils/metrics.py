@@ -0,0 +1,166 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Copyright (c) 2021 ETH Zurich, Nikita Rudin
+import glob
+import os
+import queue
+import threading
+
+import numpy as np
+from torch.utils.tensorboard import SummaryWriter
+
+
+class MetricsSink:
+    """ Destination of the training metrics. write() takes all scalars (and histograms) of one step at once,
+        flush() blocks until everything written so far is persisted. The base class drops everything.
+        write_time() is for sinks with a second step axis in seconds of training time; the others drop it, the
+        time is also logged as a value (Perf/total_time) of the iteration.
+    """
+    def write(self, step, scalars, histograms=None):
+        pass
+
+    def write_time(self, time, scalars):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class TensorBoardSink(MetricsSink):
+    """ TensorBoard event files written from a background thread.
+
+        write() only queues the batch; the writer thread turns it into add_scalar and add_histogram calls.
+    """
+    def __init__(self, log_dir, flush_secs=10):
+        self.writer = SummaryWriter(log_dir=log_dir, flush_secs=flush_secs)
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def write(self, step, scalars, histograms=None):
+        self._raise_error()
+        self.queue.put((step, scalars, histograms or dict()))
+
+    def write_time(self, time, scalars):
+        self.write(time, scalars)
+
+    def flush(self):
+        self.queue.join()
+        self._raise_error()
+        self.writer.flush()
+
+    def close(self):
+        # the writer thread ends at the None it finds after the pending batches
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+        self.writer.close()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing metrics failed") from error
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            step, scalars, histograms = item
+            try:
+                for tag, value in scalars.items():
+                    self.writer.add_scalar(tag, value, step)
+                for tag, values in histograms.items():
+                    self.writer.add_histogram(tag, values, step)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+
+class ColumnarSink(MetricsSink):
+    """ Append-only columnar metrics in log_dir/metrics_<n>.npz.
+
+        Rows are buffered in memory and every rows_per_chunk rows (and on flush) appended as a new chunk with a
+        step column and one float64 column per tag, NaN where a row has no value. Histograms are not kept.
+        read_columnar() concatenates the chunks.
+    """
+    def __init__(self, log_dir, rows_per_chunk=100):
+        self.log_dir = log_dir
+        self.rows_per_chunk = rows_per_chunk
+        self.rows = []
+        # a resumed run appends after the chunks already in log_dir
+        self.num_chunks = len(glob.glob(os.path.join(log_dir, "metrics_*.npz")))
+
+    def write(self, step, scalars, histograms=None):
+        self.rows.append((step, scalars))
+        if len(self.rows) >= self.rows_per_chunk:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        tags = sorted(set().union(*(scalars.keys() for _, scalars in self.rows)))
+        columns = {"step": np.array([step for step, _ in self.rows], dtype=np.float64)}
+        for tag in tags:
+            columns[tag] = np.array([scalars.get(tag, np.nan) for _, scalars in self.rows], dtype=np.float64)
+        np.savez(os.path.join(self.log_dir, f"metrics_{self.num_chunks:05d}.npz"), **columns)
+        self.num_chunks += 1
+        self.rows = []
+
+
+def read_columnar(log_dir):
+    """ The chunks of a ColumnarSink as one dict of columns. """
+    chunks = []
+    for path in sorted(glob.glob(os.path.join(log_dir, "metrics_*.npz"))):
+        with np.load(path) as chunk:
+            chunks.append({key: chunk[key] for key in chunk.files})
+    if not chunks:
+        return dict()
+    tags = sorted(set().union(*(chunk.keys() for chunk in chunks)))
+    return {
+        tag: np.concatenate([chunk.get(tag, np.full(len(chunk["step"]), np.nan)) for chunk in chunks])
+        for tag in tags
+    }
+
+
+def make_metrics_sink(backend, log_dir):
+    """ backend is one of "tensorboard", "columnar" or "null"; without a log_dir nothing is written. """
+    if backend == "null" or log_dir is None:
+        return MetricsSink()
+    if backend == "tensorboard":
+        return TensorBoardSink(log_dir)
+    if backend == "columnar":
+        return ColumnarSink(log_dir)
+    raise ValueError(f"Unknown metrics backend: {backend}")
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: BSD-3-Clause
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Copyright (c) 2021 ETH Zurich, Nikita Rudin
+import contextlib
+import time
+from collections import defaultdict
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+
+class PhaseProfiler:
+    """ Named phases of the training loop, measured over a window of iterations.
+
+        phase(name) is a context manager that does nothing outside a window. Inside one it opens a
+        torch.profiler.record_function range for the Chrome trace and adds the wall time of the phase, synchronized
+        with the device, to per-phase counters. Phases nest: a phase is also counted in the phase around it.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.device = None
+        self.profiler = None
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.start_time = None
+
+    def phase(self, name):
+        if not self.enabled:
+            return _disabled
+        return _Phase(self, name)
+
+    def start(self, device, trace=True):
+        """ Starts a window. Without trace only the phase counters run, without the overhead of the torch profiler. """
+        self.device = torch.device(device)
+        self.times.clear()
+        self.counts.clear()
+        if trace:
+            activities = [ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(ProfilerActivity.CUDA)
+            self.profiler = profile(activities=activities)
+            self.profiler.__enter__()
+        self.enabled = True
+        self.synchronize()
+        self.start_time = time.perf_counter()
+
+    def stop(self, num_iterations, trace_path=None):
+        """ Ends the window, writes the Chrome trace to trace_path and returns the per-phase summary table. """
+        self.synchronize()
+        window_time = time.perf_counter() - self.start_time
+        self.enabled = False
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            if trace_path is not None:
+                self.profiler.export_chrome_trace(trace_path)
+            self.profiler = None
+        return self.summary(num_iterations, window_time)
+
+    def summary(self, num_iterations, window_time):
+        lines = [f"{'phase':<28} {'calls':>8} {'total [ms]':>11} {'ms/iter':>9} {'share':>7}"]
+        for name, count in self.counts.items():
+            total = self.times[name]
+            lines.append(f"{name:<28} {count:>8} {total * 1e3:>11.1f} "
+                         f"{total * 1e3 / num_iterations:>9.2f} {total / window_time:>7.1%}")
+        lines.append(f"{'iteration':<28} {num_iterations:>8} {window_time * 1e3:>11.1f} "
+                     f"{window_time * 1e3 / num_iterations:>9.2f} {1:>7.1%}")
+        return "\n".join(lines)
+
+    def synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        elif self.device.type == "mps":
+            torch.mps.synchronize()
+
+
+class _Phase:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.range = record_function(name)
+
+    def __enter__(self):
+        # counted on entry, so the summary lists a phase before the phases nested in it
+        self.profiler.counts[self.name] += 1
+        self.profiler.synchronize()
+        self.range.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler.synchronize()
+        self.profiler.times[self.name] += time.perf_counter() - self.start
+        self.range.__exit__(*exc_info)
+
+
+_disabled = contextlib.nullcontext()
+
+# shared by the runner, the algorithm, the storage and the env
+phase_profiler = PhaseProfiler()
+
+
+def phase(name):
+    return phase_profiler.phase(name)
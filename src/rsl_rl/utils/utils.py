@@ -55,10 +55,13 @@ def split_and_pad_trajectories(tensor, dones):
     # Get length of trajectory by counting the number of successive not done elements
     done_indices = torch.cat((flat_dones.new_tensor([-1], dtype=torch.int64), flat_dones.nonzero()[:, 0]))
     trajectory_lengths = done_indices[1:] - done_indices[:-1]
-    trajectory_lengths_list = trajectory_lengths.tolist()
-    # Extract the individual trajectories
-    trajectories = torch.split(tensor.transpose(1, 0).flatten(0, 1),trajectory_lengths_list)
-    padded_trajectories = torch.nn.utils.rnn.pad_sequence(trajectories)
+    # Scatter the individual trajectories into [time, trajectory] slots on device: trajectory index and time step
+    # of every element, padded up to the rollout length
+    flat_dones = flat_dones.view(-1).long()
+    trajectory_ids = torch.cumsum(flat_dones, dim=0) - flat_dones
+    time_ids = torch.arange(flat_dones.shape[0], device=tensor.device) - (done_indices[:-1] + 1)[trajectory_ids]
+    padded_trajectories = tensor.new_zeros((tensor.shape[0], trajectory_lengths.shape[0]) + tensor.shape[2:])
+    padded_trajectories[time_ids, trajectory_ids] = tensor.transpose(1, 0).flatten(0, 1)
 
 
     trajectory_masks = trajectory_lengths > torch.arange(0, tensor.shape[0], device=tensor.device).unsqueeze(1)
@@ -0,0 +1,148 @@
+import argparse
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+
+def load_stl(path):
+    """Vertices [n, 3] of a binary or ASCII STL file."""
+    with open(path, "rb") as f:
+        data = f.read()
+    num_triangles = int(np.frombuffer(data, dtype="<u4", count=1, offset=80)[0]) if len(data) >= 84 else -1
+    if len(data) == 84 + 50 * num_triangles:
+        record = np.dtype([("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+        triangles = np.frombuffer(data, dtype=record, count=num_triangles, offset=84)
+        vertices = triangles["vertices"].reshape(-1, 3)
+    else:
+        lines = data.decode("ascii", errors="ignore").splitlines()
+        vertices = np.array(
+            [line.split()[1:4] for line in lines if line.strip().startswith("vertex")], dtype=np.float32)
+    return np.unique(vertices.astype(np.float64), axis=0)
+
+
+def quat_to_mat(quat):
+    w, x, y, z = quat / np.linalg.norm(quat)
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+    ])
+
+
+def mat_to_quat(mat):
+    w = np.sqrt(max(1.0 + np.trace(mat), 1e-12)) / 2
+    if w > 1e-3:
+        quat = np.array([w, (mat[2, 1] - mat[1, 2]) / (4 * w), (mat[0, 2] - mat[2, 0]) / (4 * w),
+                         (mat[1, 0] - mat[0, 1]) / (4 * w)])
+    else:
+        # rotation by ~pi: take the axis from the largest diagonal entry
+        i = int(np.argmax(np.diag(mat)))
+        j, k = (i + 1) % 3, (i + 2) % 3
+        s = np.sqrt(max(1.0 + mat[i, i] - mat[j, j] - mat[k, k], 1e-12)) * 2
+        quat = np.zeros(4)
+        quat[0] = (mat[k, j] - mat[j, k]) / s
+        quat[1 + i] = s / 4
+        quat[1 + j] = (mat[j, i] + mat[i, j]) / s
+        quat[1 + k] = (mat[k, i] + mat[i, k]) / s
+    return quat / np.linalg.norm(quat)
+
+
+def fit_primitive(vertices, elongation=1.5):
+    """Fit a capsule (elongated meshes) or an oriented box to the vertices, in the principal axes of the mesh.
+
+    Returns the MJCF geom attributes of the primitive, in the frame the vertices are expressed in.
+    """
+    mean = vertices.mean(axis=0)
+    _, axes = np.linalg.eigh(np.cov((vertices - mean).T))
+    projected = (vertices - mean) @ axes
+    lower, upper = projected.min(axis=0), projected.max(axis=0)
+    order = np.argsort(upper - lower)[::-1]
+    axes, lower, upper = axes[:, order], lower[order], upper[order]
+    if np.linalg.det(axes) < 0:
+        axes[:, 2] = -axes[:, 2]
+        lower[2], upper[2] = -upper[2], -lower[2]
+    extents = upper - lower
+    center = mean + axes @ ((lower + upper) / 2)
+
+    if extents[0] > elongation * extents[1]:
+        radius = extents[1] / 2
+        half_length = max(extents[0] / 2 - radius, 0.0)
+        start, end = center - half_length * axes[:, 0], center + half_length * axes[:, 0]
+        return {"type": "capsule", "size": fmt([radius]), "fromto": fmt(np.concatenate([start, end]))}
+    return {"type": "box", "size": fmt(extents / 2), "pos": fmt(center), "quat": fmt(mat_to_quat(axes))}
+
+
+def fmt(values):
+    return " ".join(f"{v:.6g}" for v in values)
+
+
+def simplify(input_path, output_path, keep_visual=False, elongation=1.5):
+    tree = ET.parse(input_path)
+    root = tree.getroot()
+    model_dir = os.path.dirname(os.path.abspath(input_path))
+    mesh_dir = os.path.join(model_dir, root.find("compiler").get("meshdir", ""))
+    mesh_files = {
+        mesh.get("name", os.path.splitext(os.path.basename(mesh.get("file")))[0]): mesh.get("file")
+        for mesh in root.iter("mesh")
+    }
+
+    replaced = []
+    parents = {child: parent for parent in root.iter() for child in parent}
+    for geom in list(root.iter("geom")):
+        parent = parents[geom]
+        if geom.get("class") == "visual":
+            if not keep_visual:
+                parent.remove(geom)
+            continue
+        if geom.get("mesh") is None:
+            continue
+
+        # mesh vertices are placed by the geom pos/quat in the body frame
+        vertices = load_stl(os.path.join(mesh_dir, mesh_files[geom.get("mesh")]))
+        rotation = quat_to_mat(np.array([float(v) for v in geom.get("quat", "1 0 0 0").split()]))
+        translation = np.array([float(v) for v in geom.get("pos", "0 0 0").split()])
+        primitive = fit_primitive(vertices @ rotation.T + translation, elongation)
+
+        for key in ("mesh", "pos", "quat"):
+            geom.attrib.pop(key, None)
+        geom.attrib.update(primitive)
+        replaced.append((parent.get("name"), primitive["type"]))
+
+    # drop mesh assets nothing refers to anymore
+    used = {geom.get("mesh") for geom in root.iter("geom")}
+    asset = root.find("asset")
+    for mesh in list(asset.iter("mesh")):
+        name = mesh.get("name", os.path.splitext(os.path.basename(mesh.get("file")))[0])
+        if name not in used:
+            asset.remove(mesh)
+
+    root.set("model", root.get("model") + "_train")
+    ET.indent(tree, space="  ")
+    tree.write(output_path)
+    return replaced
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, default="model/g1.xml")
+    parser.add_argument("-o", "--output", type=str, default="model/g1_train.xml")
+    parser.add_argument("--keep_visual", action="store_true", default=False,
+                        help="Keep the visual meshes for the viewer")
+    parser.add_argument("--elongation", type=float, default=1.5, help="Extent ratio above which a capsule is fitted")
+    args = parser.parse_args()
+
+    replaced = simplify(args.input, args.output, args.keep_visual, args.elongation)
+    for body, geom_type in replaced:
+        print(f"{body:>28} -> {geom_type}")
+    print(f"wrote {args.output}: {len(replaced)} collision meshes replaced by primitives")
+
+
+if __name__ == "__main__":
+    main()
+
+"""
+# training model without visual meshes, and the same collision model with visual meshes for the viewer
+python src/simplify_model.py -o model/g1_train.xml
+python src/simplify_model.py -o model/g1_train_vis.xml --keep_visual
+"""
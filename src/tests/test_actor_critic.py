@@ -0,0 +1,41 @@
+import torch
+from torch.distributions import Normal
+
+from rsl_rl.modules import ActorCritic
+
+
+def test_diag_gaussian_matches_normal():
+    # the DiagGaussian head against the torch.distributions.Normal path, from the same weights and seed
+    num_obs, num_actions, num_envs = 10, 4, 64
+    policy = dict(actor_hidden_dims=[32, 32], critic_hidden_dims=[32, 32], activation="elu")
+    torch.manual_seed(0)
+    heads = {
+        "Normal": ActorCritic(num_obs, num_obs, num_actions, **policy),
+        "DiagGaussian": ActorCritic(num_obs, num_obs, num_actions, diag_gaussian=True, **policy),
+    }
+    with torch.no_grad():
+        heads["Normal"].std.uniform_(-1.0, 0.5)
+    heads["DiagGaussian"].load_state_dict(heads["Normal"].state_dict())
+    obs = torch.randn(num_envs, num_obs)
+    old_mu = torch.randn(num_envs, num_actions)
+    old_sigma = torch.rand(num_envs, num_actions) + 0.1
+
+    results = dict()
+    for name, actor_critic in heads.items():
+        torch.manual_seed(0)
+        actions = actor_critic.act(obs).detach()
+        log_prob = actor_critic.get_actions_log_prob(actions)
+        with torch.no_grad():
+            kl = actor_critic.kl(old_mu, old_sigma)
+        results[name] = actions, log_prob.detach(), actor_critic.entropy.detach(), kl
+
+    for field, normal, diag in zip(("sample", "log_prob", "entropy", "kl"), results["Normal"], results["DiagGaussian"]):
+        torch.testing.assert_close(diag, normal, rtol=1e-5, atol=1e-5,
+                                   msg=lambda message: f"DiagGaussian {field} differs: {message}")
+
+    # the closed-form KL against torch.distributions; the 1e-5 inside its log bounds the difference per action
+    # by about 1e-5 / (std / old_std)
+    diag = heads["DiagGaussian"]
+    reference_kl = torch.distributions.kl_divergence(
+        Normal(old_mu, old_sigma), Normal(diag.action_mean, diag.action_std)).sum(dim=-1)
+    torch.testing.assert_close(results["DiagGaussian"][3], reference_kl, rtol=1e-4, atol=1e-3)
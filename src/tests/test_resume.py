@@ -0,0 +1,18 @@
+import argparse
+
+import pytest
+import torch
+
+gs = pytest.importorskip("genesis")
+
+
+def test_resumed_runs_match_uninterrupted(tmp_path):
+    # a small scene on CPU: two runs resumed halfway from the checkpoint with env state end up bit-identical to the
+    # uninterrupted run
+    from benchmark import resume_runs
+
+    gs.init(backend=gs.cpu, logging_level="warning")
+    args = argparse.Namespace(exp_name="stand", num_envs=16, device="cpu")
+    results = {run: result for run, _, _, result in resume_runs(args, str(tmp_path), iterations=4)}
+    assert torch.equal(results["resumed"], results["uninterrupted"])
+    assert torch.equal(results["resumed again"], results["uninterrupted"])
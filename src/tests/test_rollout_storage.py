@@ -0,0 +1,100 @@
+import argparse
+
+import pytest
+import torch
+
+from rsl_rl.storage import RolloutStorage
+
+
+def make_storage(num_envs=16, num_steps=8, **kwargs):
+    storage = RolloutStorage(num_envs, num_steps, [3], [None], [2], **kwargs)
+    storage.rewards.normal_()
+    storage.values.normal_()
+    storage.dones.copy_(torch.rand(storage.dones.shape) < 0.2)
+    return storage
+
+
+def reference_returns(rewards, values, dones, last_values, gamma, lam):
+    # GAE per env and step in float64
+    num_steps, num_envs = rewards.shape[:2]
+    returns = torch.zeros(num_steps, num_envs, 1, dtype=torch.float64)
+    for env in range(num_envs):
+        advantage = 0.0
+        for step in reversed(range(num_steps)):
+            next_values = last_values[env] if step == num_steps - 1 else values[step + 1, env]
+            not_done = 1.0 - float(dones[step, env])
+            delta = rewards[step, env].item() + not_done * gamma * next_values.item() - values[step, env].item()
+            advantage = delta + not_done * gamma * lam * advantage
+            returns[step, env] = advantage + values[step, env].item()
+    return returns
+
+
+def test_compute_returns_matches_reference():
+    torch.manual_seed(0)
+    storage = make_storage()
+    last_values = torch.randn(storage.num_envs, 1)
+    storage.compute_returns(last_values, 0.99, 0.95)
+
+    returns = reference_returns(storage.rewards, storage.values, storage.dones, last_values, 0.99, 0.95)
+    torch.testing.assert_close(storage.returns.double(), returns, rtol=1e-5, atol=1e-5)
+    advantages = returns - storage.values.double()
+    advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+    torch.testing.assert_close(storage.advantages.double(), advantages, rtol=1e-5, atol=1e-5)
+
+
+def test_compute_returns_masked_normalization():
+    torch.manual_seed(0)
+    storage = make_storage(sample_mask=True)
+    storage.weights.copy_(torch.rand(storage.weights.shape) < 0.7)
+    storage.compute_returns(torch.randn(storage.num_envs, 1), 0.99, 0.95)
+
+    mask = storage.weights.bool()
+    assert torch.all(storage.advantages[~mask] == 0)
+    assert storage.advantages[mask].mean().abs().item() < 1e-5
+    assert abs(storage.advantages[mask].std().item() - 1.0) < 1e-4
+
+
+def test_compiled_compute_returns_matches_loop():
+    torch.manual_seed(0)
+    loop = make_storage()
+    compiled = make_storage(compile_gae=True)
+    compiled.data.copy_(loop.data)
+    compiled.rewards.copy_(loop.rewards)
+    compiled.dones.copy_(loop.dones)
+    last_values = torch.randn(loop.num_envs, 1)
+
+    loop.compute_returns(last_values, 0.99, 0.95)
+    compiled.compute_returns(last_values, 0.99, 0.95)
+    torch.testing.assert_close(compiled.returns, loop.returns, rtol=1e-6, atol=1e-6)
+    torch.testing.assert_close(compiled.advantages, loop.advantages, rtol=1e-6, atol=1e-6)
+
+
+def flatten_batch(batch):
+    # the tensors of a minibatch tuple, with the nested hidden states
+    for item in batch:
+        if isinstance(item, (tuple, list)):
+            yield from flatten_batch(item)
+        elif item is not None:
+            yield item
+
+
+def test_recurrent_mini_batches_match_previous_generator():
+    pytest.importorskip("genesis")
+    from benchmark import fill_storage, make_ppo, reference_recurrent_mini_batches
+    from rsl_rl.modules import ActorCriticRecurrent
+
+    args = argparse.Namespace(exp_name="kicker_v1", num_envs=32, device="cpu")
+    torch.manual_seed(0)
+    alg = make_ppo(args, actor_critic_class=ActorCriticRecurrent)
+    fill_storage(alg, args)
+    storage = alg.storage
+    num_mini_batches, num_epochs = alg.num_mini_batches, alg.num_learning_epochs
+
+    batches = list(storage.reccurent_mini_batch_generator(num_mini_batches, num_epochs))
+    references = list(reference_recurrent_mini_batches(storage, num_mini_batches, num_epochs))
+    assert len(batches) == len(references) == num_mini_batches * num_epochs
+    for reference, batch in zip(references, batches):
+        reference, batch = list(flatten_batch(reference)), list(flatten_batch(batch))
+        assert len(reference) == len(batch)
+        for expected, actual in zip(reference, batch):
+            assert torch.equal(actual, expected)
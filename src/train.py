@@ -26,6 +26,7 @@ def get_train_cfg(exp_name, max_iterations):
             "schedule": "adaptive",
             "use_clipped_value_loss": True,
             "value_loss_coef": 1.0,
+            "write_through": True,
         },
         "policy": {
             "activation": "elu",
@@ -37,15 +38,22 @@ def get_train_cfg(exp_name, max_iterations):
             "algorithm_class_name": "PPO",
             "checkpoint": -1,
             "experiment_name": exp_name,
+            "keep_best_checkpoints": 5,
+            "keep_last_checkpoints": 10,
             "load_run": -1,
             "log_interval": 1,
             "max_iterations": max_iterations,
+            "metrics_backend": "tensorboard",
             "num_steps_per_env": 64,
             "policy_class_name": "ActorCritic",
+            "profile_iterations": 0,
+            "profile_start": 10,
+            "prune_existing_checkpoints": False,
             "record_interval": -1,
             "resume": False,
             "resume_path": None,
             "run_name": "",
+            "save_env_state": "final",
             "save_interval": 50,
         },
         "runner_class_name": "OnPolicyRunner",
@@ -153,6 +161,8 @@ def main():
     parser.add_argument("-e", "--exp_name", type=str, default="kicker")
     parser.add_argument("-B", "--num_envs", type=int, default=2048)
     parser.add_argument("--max_iterations", type=int, default=1000)
+    parser.add_argument("--profile_iterations", type=int, default=0,
+                        help="Profile this many iterations after the first 10, writes trace.json and profile.txt")
     args = parser.parse_args()
 
     gs.init(logging_level="warning")
@@ -162,6 +172,7 @@ def main():
 
     env_cfg, obs_cfg, reward_cfg, command_cfg = get_cfgs()
     train_cfg = get_train_cfg(args.exp_name, args.max_iterations)
+    train_cfg["runner"]["profile_iterations"] = args.profile_iterations
     reward_cfg["reward_scales"] = get_reward_scales(args.exp_name)
 
     if os.path.exists(log_dir):
@@ -188,4 +199,6 @@ if __name__ == "__main__":
 """
 # training
 python src/train.py -e stand --max_iterations 20000
+# phase profile of iterations 10-14: logs/stand/trace.json (chrome://tracing, Perfetto) and logs/stand/profile.txt
+python src/train.py -e stand --max_iterations 20 --profile_iterations 5
 """